@@ -64,6 +64,102 @@ class BinToBcd(Elaboratable):
 
         return m
 
+# unrolled version of the above, with the iterations spread over 'stages'
+# register stages. accepts a new value with 'trg' on every clock, the result
+# appears 'stages' clocks later together with a pulse on 'rdy'. 'bcd' keeps
+# the last result until the next one arrives.
+
+class BinToBcdPipelined(Elaboratable):
+    def __init__(self, bits=8, stages=4):
+        self.bin_bits = bits
+        self.stages = min(stages, bits)
+        self.digits = math.ceil(self.bin_bits / 3)
+        self.bcd_bits = 4 * self.digits
+
+        self.bin = Signal(self.bin_bits)
+        self.bcd = Signal(self.bcd_bits)
+        self.trg = Signal()
+        self.rdy = Signal()
+
+        self.ports = [
+                self.bin,
+                self.bcd,
+                self.trg,
+                self.rdy
+                ]
+
+    def iteration(self, m, mem, name):
+        value = Signal.like(mem, name=name)
+        digits = []
+        for i in range(self.digits):
+            digit = mem[self.bin_bits + i * 4:self.bin_bits + (i + 1) * 4]
+            digits.append(Mux(digit > 4, digit + 3, digit)[:4])
+        m.d.comb += value.eq(Cat(Const(0, 1), mem[:self.bin_bits], *digits))
+        return value
+
+    def elaborate(self, platform):
+        m = Module()
+
+        per_stage = math.ceil(self.bin_bits / self.stages)
+
+        mem = Signal(self.bin_bits + self.bcd_bits, name="mem_in")
+        valid = self.trg
+        m.d.comb += mem.eq(self.bin)
+
+        done = 0
+        for stage in range(self.stages):
+            value = mem
+            for i in range(min(per_stage, self.bin_bits - done)):
+                value = self.iteration(m, value, "iter{}".format(done))
+                done += 1
+
+            mem_next = Signal.like(mem, name="mem{}".format(stage))
+            valid_next = Signal(name="valid{}".format(stage))
+            m.d.sync += valid_next.eq(valid)
+            with m.If(valid == 1):
+                m.d.sync += mem_next.eq(value)
+            mem = mem_next
+            valid = valid_next
+
+        m.d.comb += [
+                self.bcd.eq(mem[self.bin_bits:]),
+                self.rdy.eq(valid)
+                ]
+
+        return m
+
+def sim_pipelined():
+    dut = BinToBcdPipelined(bits=32, stages=5)
+
+    sim = Simulator(dut)
+
+    values = [0, 9, 42, 255, 1337, 24356, 99999999, 1234567890, 2**32 - 1]
+
+    def to_bcd(n):
+        return int(str(n), 16)
+
+    def proc():
+        results = []
+        for n in values + [None] * (dut.stages + 1):
+            if n is not None:
+                yield dut.bin.eq(n)
+            yield dut.trg.eq(n is not None)
+            yield Tick()
+            yield Settle()
+            if (yield dut.rdy) == 1:
+                results.append((yield dut.bcd))
+        assert results == [to_bcd(n) for n in values]
+        # result is kept
+        yield Tick()
+        yield Settle()
+        assert (yield dut.bcd) == to_bcd(values[-1])
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    with sim.write_vcd('bintobcd_pipe.vcd', 'bintobcd_pipe.gtkw',
+                       traces=dut.ports):
+        sim.run()
+
 if __name__ == '__main__':
     dut = BinToBcd(bits=16)
 
@@ -97,3 +193,5 @@ if __name__ == '__main__':
     sim.add_sync_process(proc)
     with sim.write_vcd('bintobcd.vcd', 'bintobcd.gtkw', traces=dut.ports):
         sim.run()
+
+    sim_pipelined()
@@ -0,0 +1,215 @@
+from amaranth import *
+from amaranth.sim import *
+from amaranth.lib.memory import Memory
+
+# Consistent overhead byte stuffing (COBS) encoder.
+# see e.g.: https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing
+#
+# Sits between a byte producer and a UART TX. Bytes are accepted with 'trg'
+# whenever 'rdy' is high, the last byte of a frame is marked with 'last'.
+# The encoded frame contains no zero bytes and is terminated by a single
+# 0x00 delimiter, so a receiver can resynchronise at the next zero byte.
+#
+# Non-zero bytes are buffered until a zero byte, the end of the frame or
+# 254 non-zero bytes are seen. The block is then sent with its code byte
+# in front, back to back as long as 'tx_rdy' is high.
+
+COBS_BLOCK = 254
+
+class CobsEncoder(Elaboratable):
+    def __init__(self):
+        # byte producer side
+        self.data = Signal(8)
+        self.trg = Signal()
+        self.last = Signal()
+        self.rdy = Signal()
+
+        # UART side
+        self.tx = Signal(8)
+        self.tx_trg = Signal()
+        self.tx_rdy = Signal()
+
+        self.ports = [
+            self.data,
+            self.trg,
+            self.last,
+            self.rdy,
+            self.tx,
+            self.tx_trg,
+            self.tx_rdy
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n = Signal(range(COBS_BLOCK + 1))
+        pos = Signal(range(COBS_BLOCK + 1))
+        pos_next = Signal.like(pos)
+        code = Signal(8)
+        frame_end = Signal()
+        extra_empty = Signal()
+        byte = Signal(8)
+        sending = Signal()
+
+        m.submodules.storage = storage = Memory(
+                shape=unsigned(8), depth=COBS_BLOCK, init=[])
+        w_port = storage.write_port()
+        r_port = storage.read_port()
+
+        # address the next byte early, so it is ready when tx_rdy returns
+        m.d.comb += [
+            w_port.addr.eq(n),
+            w_port.data.eq(self.data),
+            r_port.addr.eq(pos_next),
+            pos_next.eq(pos),
+            self.tx.eq(byte),
+            self.tx_trg.eq(sending & self.tx_rdy)
+        ]
+
+        with m.FSM(reset="FILL") as fsm:
+
+            m.d.comb += self.rdy.eq(fsm.ongoing("FILL"))
+
+            with m.State("FILL"):
+                m.d.sync += pos.eq(0)
+                with m.If(self.trg == 1):
+                    with m.If(self.data == 0):
+                        m.d.sync += [
+                            code.eq(n + 1),
+                            frame_end.eq(self.last),
+                            extra_empty.eq(self.last)
+                        ]
+                        m.next = "CODE"
+                    with m.Else():
+                        m.d.comb += w_port.en.eq(1)
+                        m.d.sync += n.eq(n + 1)
+                        with m.If(self.last == 1):
+                            m.d.sync += [
+                                code.eq(n + 2),
+                                frame_end.eq(1),
+                                extra_empty.eq(0)
+                            ]
+                            m.next = "CODE"
+                        with m.Elif(n == COBS_BLOCK - 1):
+                            m.d.sync += [
+                                code.eq(0xff),
+                                frame_end.eq(0),
+                                extra_empty.eq(0)
+                            ]
+                            m.next = "CODE"
+
+            with m.State("CODE"):
+                m.d.comb += [
+                    byte.eq(code),
+                    sending.eq(1)
+                ]
+                with m.If(self.tx_rdy == 1):
+                    with m.If(n == 0):
+                        m.next = "BLOCK_DONE"
+                    with m.Else():
+                        m.next = "DATA"
+
+            with m.State("DATA"):
+                m.d.comb += [
+                    byte.eq(r_port.data),
+                    sending.eq(1)
+                ]
+                with m.If(self.tx_rdy == 1):
+                    m.d.comb += pos_next.eq(pos + 1)
+                    m.d.sync += pos.eq(pos_next)
+                    with m.If(pos == n - 1):
+                        m.next = "BLOCK_DONE"
+
+            with m.State("BLOCK_DONE"):
+                m.d.sync += n.eq(0)
+                with m.If(extra_empty == 1):
+                    m.next = "EMPTY"
+                with m.Elif(frame_end == 1):
+                    m.next = "DELIMITER"
+                with m.Else():
+                    m.next = "FILL"
+
+            # a frame ending in a zero byte needs an empty block after it
+            with m.State("EMPTY"):
+                m.d.comb += [
+                    byte.eq(0x01),
+                    sending.eq(1)
+                ]
+                with m.If(self.tx_rdy == 1):
+                    m.next = "DELIMITER"
+
+            with m.State("DELIMITER"):
+                m.d.comb += [
+                    byte.eq(0x00),
+                    sending.eq(1)
+                ]
+                with m.If(self.tx_rdy == 1):
+                    m.next = "FILL"
+
+        return m
+
+def cobs_encode(frame):
+    out = bytearray()
+    block = bytearray()
+    for b in frame:
+        if b == 0:
+            out += bytes([len(block) + 1]) + block
+            block = bytearray()
+        else:
+            block.append(b)
+            if len(block) == COBS_BLOCK:
+                out += bytes([0xff]) + block
+                block = bytearray()
+    if block or not frame or frame[-1] == 0:
+        out += bytes([len(block) + 1]) + block
+    return bytes(out) + b"\x00"
+
+def cobs_decode(data):
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        code = data[pos]
+        out += data[pos + 1:pos + code]
+        pos += code
+        if code != 0xff and pos < len(data):
+            out.append(0)
+    return bytes(out)
+
+if __name__ == '__main__':
+    from serial_encoder import sim_uart
+
+    dut = CobsEncoder()
+
+    sim = Simulator(dut)
+
+    frames = [b"\x01\x02\x03", b"\x00", b"\x11\x00\x00\x22\x00",
+              b"\xff\xff\xff\xff\xff\xff", bytes(range(1, 256)) * 2,
+              bytes(range(1, 255)), b"\x05"]
+    received = []
+
+    def write_frame(frame):
+        for i, b in enumerate(frame):
+            yield dut.data.eq(b)
+            yield dut.last.eq(i == len(frame) - 1)
+            yield dut.trg.eq(1)
+            yield
+            while (yield dut.rdy) == 0:
+                yield
+        yield dut.trg.eq(0)
+        yield
+
+    def proc():
+        for frame in frames:
+            yield from write_frame(frame)
+        for i in range(5000):
+            yield
+        expected = b"".join(cobs_encode(f) for f in frames)
+        assert bytes(received) == expected
+        assert [cobs_decode(f) for f in expected.split(b"\x00")[:-1]] \
+            == frames
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(sim_uart(dut, received))
+    with sim.write_vcd('cobs.vcd', 'cobs_orig.gtkw', traces=dut.ports):
+        sim.run()
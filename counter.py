@@ -2,8 +2,12 @@ from amaranth import *
 from amaranth.sim import *
 from amaranth.lib import wiring
 from amaranth.lib.wiring import In, Out
+from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
+from amaranth.lib.memory import Memory
+from amaranth.utils import bits_for
 
 from edge_detect import EdgeDetector
+from register_list import REG_RW, REG_RO, REG_STROBE
 
 class Counter(wiring.Component):
     input: In(1)
@@ -38,30 +42,600 @@ class Counter(wiring.Component):
 
         return m
 
+# Counter running in a faster clock domain, e.g. next to the TDC, with the
+# count read in sync. The count is Gray coded in 'domain' and passed with an
+# FFSynchronizer, only one bit changes per increment, so sync never sees a
+# torn value. 'count' lags the fast counter by the synchroniser stages.
+#
+# 'enable' is synchronised to 'domain', a pulse on 'latch' is passed with a
+# PulseSynchronizer and latches the fast count there. The latched count is
+# stable until the next latch, it is copied to 'count_latched' after the
+# pulse has come back to sync. 'input' is in 'domain', the other signals
+# in sync.
+
 class CounterSync(Elaboratable):
-    def __init__(self, name, bits):
+    def __init__(self, name, bits, domain="fast", rising=True, falling=False):
+        self.name = name
         self.bits = bits
+        self.domain = domain
 
-        self.counter = Counter(bits=self.bits)
-        self.counter_s = Signal.like(self.counter.count)
-        self.counter_ffs = FFSynchronizer(self.counter.count, self.counter_s,
-                                          o_domain="sync")
+        self.counter = Counter(bits=bits, rising=rising, falling=falling)
+        self.input = Signal()
+        self.enable = Signal()
+        self.latch = Signal()
+        self.count = Signal(bits)
+        self.count_latched = Signal(bits)
+        self.latched = Signal()
 
     def connect(self, _input, latch, enable, output, latched_output):
         return [
-            self.counter.input.eq(_input),
-            self.counter.enable.eq(_enable),
-            counter.latch.eq(latch),
-            output.eq(counter_s),
-            latched_output.eq(counter.count_latched),
+            self.input.eq(_input),
+            self.enable.eq(enable),
+            self.latch.eq(latch),
+            output.eq(self.count),
+            latched_output.eq(self.count_latched),
         ]
 
     def elaborate(self, platform):
         m = Module()
-        m.submodules["counter_"+name] = self.counter
-        m.submodules["counter_ffs_"+name] = self.counter_ffs
+        domain = self.domain
+        m.submodules["counter_" + self.name] = DomainRenamer(domain)(
+            self.counter)
+
+        enable = Signal()
+        m.submodules.enable_ffs = FFSynchronizer(self.enable, enable,
+                                                 o_domain=domain)
+        m.submodules.latch_to = latch_to = PulseSynchronizer("sync", domain)
+        m.submodules.latch_from = latch_from = PulseSynchronizer(domain,
+                                                                 "sync")
+        m.d.comb += [
+            self.counter.input.eq(self.input),
+            self.counter.enable.eq(enable),
+            self.counter.latch.eq(latch_to.o),
+            latch_to.i.eq(self.latch)
+        ]
+        # count_latched is written in the cycle after the latch pulse
+        m.d[domain] += latch_from.i.eq(latch_to.o)
+
+        count = self.counter.count
+        gray = Signal(self.bits)
+        gray_s = Signal(self.bits)
+        m.d[domain] += gray.eq(count ^ (count >> 1))
+        m.submodules.count_ffs = FFSynchronizer(gray, gray_s, o_domain="sync")
+
+        binary = Signal(self.bits)
+        for i in range(self.bits):
+            m.d.comb += binary[i].eq(gray_s[i:].xor())
+        m.d.sync += [
+            self.count.eq(binary),
+            self.latched.eq(latch_from.o)
+        ]
+        with m.If(latch_from.o):
+            m.d.sync += self.count_latched.eq(self.counter.count_latched)
+
+        return m
+
+# Takes a snapshot of many counters at once. A pulse on 'strobe' (or a
+# write of 1 to the 'snapshot' register) copies every counter added with
+# add() into its shadow register, all counters of a clock domain in the same
+# cycle of that domain. For other domains than sync, the strobe is passed
+# with a PulseSynchronizer, the counters are held there and copied to the
+# sync shadow once the hold registers are stable. The domains see the
+# strobe a few cycles apart, given by the synchronisers. 'ready' is low
+# while a snapshot is in progress.
+#
+# add_registers() adds the strobe and the shadow registers as a register
+# list to a RegisterTable, so one block read returns a coherent set.
+
+class CounterSnapshot(Elaboratable):
+    def __init__(self):
+        self.strobe = Signal()
+        self.ready = Signal()
+        self.counters = []
+        self.regs = None
+
+    def add(self, counter, domain="sync", name=None):
+        if name is None:
+            name = counter.name
+        shadow = Signal.like(counter, name=name + "_snapshot")
+        self.counters.append((counter, domain, shadow, name))
+        return shadow
+
+    def add_registers(self, table, name, offset, description=None):
+        names = [("snapshot", 1, 0, "write 1 to take a snapshot",
+                  REG_STROBE)]
+        names += [(n, len(shadow), 0, None, REG_RO)
+                  for _, _, shadow, n in self.counters]
+        table.add_list(name, offset, description, names=names)
+        self.regs = table.dict[name]
+        return self.regs
+
+    def elaborate(self, platform):
+        m = Module()
+
+        strobe = Signal()
+        m.d.comb += strobe.eq(self.strobe)
+        if self.regs is not None:
+            m.d.comb += strobe.eq(self.strobe | self.regs["snapshot"].signal)
+            for _, _, shadow, n in self.counters:
+                m.d.comb += self.regs[n].signal.eq(shadow)
+
+        domains = []
+        for _, domain, _, _ in self.counters:
+            if domain not in domains and domain != "sync":
+                domains.append(domain)
+
+        with m.If(strobe):
+            for counter, domain, shadow, _ in self.counters:
+                if domain == "sync":
+                    m.d.sync += shadow.eq(counter)
+
+        pending = Signal(max(len(domains), 1))
+        m.d.comb += self.ready.eq(pending == 0)
+
+        for i, domain in enumerate(domains):
+            to_domain = PulseSynchronizer("sync", domain)
+            to_sync = PulseSynchronizer(domain, "sync")
+            m.submodules["snapshot_to_" + domain] = to_domain
+            m.submodules["snapshot_from_" + domain] = to_sync
+            captured = Signal(name="captured_" + domain)
+            m.d.comb += to_domain.i.eq(strobe)
+            m.d[domain] += captured.eq(to_domain.o)
+            m.d.comb += to_sync.i.eq(captured)
+
+            for counter, d, shadow, n in self.counters:
+                if d != domain:
+                    continue
+                hold = Signal.like(counter, name=n + "_hold")
+                with m.If(to_domain.o):
+                    m.d[domain] += hold.eq(counter)
+                with m.If(to_sync.o):
+                    m.d.sync += shadow.eq(hold)
+
+            with m.If(strobe):
+                m.d.sync += pending[i].eq(1)
+            with m.Elif(to_sync.o):
+                m.d.sync += pending[i].eq(0)
+
+        return m
+
+# Counters for n inputs with the counts in a memory (BRAM) instead of
+# registers. Edges are collected per input in a small accumulator of
+# acc_bits. A scanner visits one input per cycle, reads its count from the
+# memory and writes back count + accumulator, so every input is visited
+# every n cycles and acc_bits is sized to hold the edges of n cycles.
+#
+# Edges and 'enable' work as in Counter. A pulse on 'latch' moves all
+# accumulators to a second set, the next visit of each input then writes
+# the count of the latch cycle to the latched memory. Latches have to be at
+# least n + 2 cycles apart.
+#
+# r_data and r_data_latched show the count and latched count of input
+# r_addr one cycle later (read_latency = 1). r_data lags the live count by
+# up to n + 2 cycles, the edges in the accumulator are not included.
+
+class CounterBank(Elaboratable):
+    def __init__(self, n, bits=32, rising=True, falling=False):
+        self.n = n
+        self.bits = bits
+        self.rising = rising
+        self.falling = falling
+        max_edges = (n + 2) if (rising and falling) else (n + 2) // 2 + 1
+        self.acc_bits = bits_for(max_edges)
+        self.read_latency = 1
+
+        self.input = Signal(n)
+        self.enable = Signal()
+        self.latch = Signal()
+        self.r_addr = Signal(range(n))
+        self.r_data = Signal(bits)
+        self.r_data_latched = Signal(bits)
+
+    def elaborate(self, platform):
+        m = Module()
+        n = self.n
+
+        m.submodules.counts = counts = Memory(
+                shape=unsigned(self.bits), depth=n, init=[])
+        m.submodules.latched = latched = Memory(
+                shape=unsigned(self.bits), depth=n, init=[])
+        scan_w = counts.write_port()
+        # with n = 1 the write back and the next read hit the same address
+        scan_r = counts.read_port(transparent_for=(scan_w,))
+        host_r = counts.read_port()
+        latched_w = latched.write_port()
+        latched_r = latched.read_port()
+
+        m.d.comb += [
+            host_r.addr.eq(self.r_addr),
+            latched_r.addr.eq(self.r_addr),
+            self.r_data.eq(host_r.data),
+            self.r_data_latched.eq(latched_r.data)
+        ]
+
+        prev = Signal(n)
+        edge = Signal(n)
+        m.d.sync += prev.eq(self.input)
+        rose = self.input & ~prev
+        fell = ~self.input & prev
+        if self.rising and self.falling:
+            m.d.comb += edge.eq(Mux(self.enable, rose | fell, 0))
+        elif self.falling:
+            m.d.comb += edge.eq(Mux(self.enable, fell, 0))
+        else:
+            m.d.comb += edge.eq(Mux(self.enable, rose, 0))
+
+        acc = Array([Signal(self.acc_bits, name="acc{}".format(i))
+                     for i in range(n)])
+        acc_latched = Array([Signal(self.acc_bits, name="acc_latched{}".format(i))
+                             for i in range(n)])
+        pending = Signal(n)
+
+        # scanner: read ptr, one cycle later write back channel ch
+        ptr = Signal(range(n))
+        ch = Signal(range(n))
+        visiting = Signal()
+        m.d.sync += [
+            ptr.eq(Mux(ptr == n - 1, 0, ptr + 1)),
+            ch.eq(ptr),
+            visiting.eq(1)
+        ]
+        m.d.comb += scan_r.addr.eq(ptr)
+
+        for i in range(n):
+            with m.If(self.latch):
+                m.d.sync += [
+                    acc[i].eq(edge[i]),
+                    acc_latched[i].eq(acc[i]),
+                    pending[i].eq(1)
+                ]
+            with m.Else():
+                m.d.sync += acc[i].eq(acc[i] + edge[i])
+
+        base = Signal(self.bits)
+        count = Signal(self.bits)
+        m.d.comb += [
+            base.eq(scan_r.data + Mux(pending.bit_select(ch, 1),
+                                      acc_latched[ch], 0)),
+            count.eq(base + acc[ch]),
+            scan_w.addr.eq(ch),
+            scan_w.data.eq(count),
+            scan_w.en.eq(visiting),
+            latched_w.addr.eq(ch)
+        ]
+
+        with m.If(visiting):
+            m.d.sync += acc[ch].eq(edge.bit_select(ch, 1))
+            with m.If(self.latch):
+                # the whole count is the latched count
+                m.d.comb += [
+                    latched_w.data.eq(count),
+                    latched_w.en.eq(1)
+                ]
+                m.d.sync += [
+                    acc_latched[ch].eq(0),
+                    pending.bit_select(ch, 1).eq(0)
+                ]
+            with m.Elif(pending.bit_select(ch, 1)):
+                m.d.comb += [
+                    latched_w.data.eq(base),
+                    latched_w.en.eq(1)
+                ]
+                m.d.sync += pending.bit_select(ch, 1).eq(0)
+
+        return m
+
+# Counts edges of n inputs over a gate of 'gate' sync cycles. At the end
+# of every gate the counts are copied to 'rates' and the counting starts
+# again from zero, so 'rates' always holds the counts of the last completed
+# gate and no edge is lost between gates. 'gates' counts the completed gates
+# and 'done' pulses when 'rates' changes. A new gate length is used from the
+# next gate on, a gate of 0 stops the meter. The first gate after a stop
+# starts the cycle after the gate length is set, only full gates are
+# published.
+#
+# add_registers() adds the gate length, the gate count and the rates to a
+# RegisterTable. The host reads 'gates' before and after the rates to see
+# whether a gate ended in between.
+
+class RateMeter(Elaboratable):
+    def __init__(self, n=1, bits=32, gate_bits=32, rising=True, falling=False):
+        self.n = n
+        self.bits = bits
+        self.rising = rising
+        self.falling = falling
+
+        self.input = Signal(n)
+        self.gate = Signal(gate_bits)
+        self.rates = [Signal(bits, name="rate{}".format(i)) for i in range(n)]
+        self.gates = Signal(16)
+        self.done = Signal()
+        self.regs = None
+
+    def add_registers(self, table, name, offset, description=None):
+        names = [("gate", len(self.gate), 0, "gate length in cycles",
+                  REG_RW),
+                 ("gates", len(self.gates), 0, "completed gates", REG_RO)]
+        names += [(rate.name, self.bits, 0, None, REG_RO)
+                  for rate in self.rates]
+        table.add_list(name, offset, description, names=names)
+        self.regs = table.dict[name]
+        return self.regs
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.regs is not None:
+            m.d.comb += [
+                self.gate.eq(self.regs["gate"].signal),
+                self.regs["gates"].signal.eq(self.gates)
+            ]
+            for rate in self.rates:
+                m.d.comb += self.regs[rate.name].signal.eq(rate)
+
+        prev = Signal(self.n)
+        edge = Signal(self.n)
+        m.d.sync += prev.eq(self.input)
+        rose = self.input & ~prev
+        fell = ~self.input & prev
+        if self.rising and self.falling:
+            m.d.comb += edge.eq(rose | fell)
+        elif self.falling:
+            m.d.comb += edge.eq(fell)
+        else:
+            m.d.comb += edge.eq(rose)
+
+        counts = [Signal(self.bits, name="count{}".format(i))
+                  for i in range(self.n)]
+        timer = Signal.like(self.gate)
+        running = Signal()
+        m.d.sync += self.done.eq(0)
+
+        with m.If(self.gate == 0):
+            m.d.sync += [
+                timer.eq(0),
+                running.eq(0)
+            ]
+            for count in counts:
+                m.d.sync += count.eq(0)
+        with m.Elif(running == 0):
+            # the first gate starts in the next cycle, nothing to publish yet
+            m.d.sync += [
+                timer.eq(self.gate - 1),
+                running.eq(1)
+            ]
+        with m.Elif(timer == 0):
+            m.d.sync += [
+                timer.eq(self.gate - 1),
+                self.gates.eq(self.gates + 1),
+                self.done.eq(1)
+            ]
+            for i, count in enumerate(counts):
+                m.d.sync += [
+                    self.rates[i].eq(count + edge[i]),
+                    count.eq(0)
+                ]
+        with m.Else():
+            m.d.sync += timer.eq(timer - 1)
+            for i, count in enumerate(counts):
+                m.d.sync += count.eq(count + edge[i])
+
         return m
 
+def sim_rate():
+    dut = RateMeter(n=3, bits=16)
+    sim = Simulator(dut)
+    # inputs toggle every 1, 2 and 5 cycles: a rising edge every 2, 4, 10
+    periods = [2, 4, 10]
+
+    def inputs():
+        yield Passive()
+        k = 0
+        while True:
+            yield dut.input.eq(sum(((k // (p // 2)) & 1) << i
+                                   for i, p in enumerate(periods)))
+            k += 1
+            yield
+
+    def wait_gates(results, n):
+        while len(results) < n:
+            yield
+            if (yield dut.done):
+                rates = []
+                for rate in dut.rates:
+                    rates.append((yield rate))
+                results.append(((yield dut.gates), rates))
+
+    def proc():
+        results = []
+        yield dut.gate.eq(100)
+        yield from wait_gates(results, 4)
+        yield dut.gate.eq(40)
+        yield from wait_gates(results, 8)
+        # the gate in which the length was written is still 100 long
+        for gates_done, rates in results[:5]:
+            assert rates == [100 // p for p in periods], (gates_done, rates)
+        for gates_done, rates in results[5:]:
+            assert rates == [40 // p for p in periods], (gates_done, rates)
+        assert [g for g, _ in results] == list(range(1, 9))
+
+        yield dut.gate.eq(0)
+        for _ in range(200):
+            yield
+            assert not (yield dut.done)
+
+        # starting again publishes only full gates
+        yield dut.gate.eq(40)
+        yield from wait_gates(results, 10)
+        for gates_done, rates in results[8:]:
+            assert rates == [40 // p for p in periods], (gates_done, rates)
+        assert [g for g, _ in results[8:]] == [9, 10]
+
+    sim.add_clock(1e-8)
+    sim.add_sync_process(inputs)
+    sim.add_sync_process(proc)
+    sim.run()
+
+def sim_bank(n=8, rising=True, falling=False):
+    import random
+
+    dut = CounterBank(n, bits=16, rising=rising, falling=falling)
+    m = Module()
+    m.submodules.dut = dut
+    refs = []
+    for i in range(n):
+        ref = Counter(bits=16, rising=rising, falling=falling)
+        m.submodules["ref{}".format(i)] = ref
+        m.d.comb += [
+            ref.input.eq(dut.input[i]),
+            ref.enable.eq(dut.enable),
+            ref.latch.eq(dut.latch)
+        ]
+        refs.append(ref)
+
+    sim = Simulator(m)
+    rng = random.Random(1)
+
+    def compare():
+        for i in range(n):
+            yield dut.r_addr.eq(i)
+            yield
+            yield
+            assert (yield dut.r_data) == (yield refs[i].count), i
+            assert (yield dut.r_data_latched) == \
+                (yield refs[i].count_latched), i
+
+    def proc():
+        yield dut.enable.eq(1)
+        for k in range(600):
+            # dense toggling, including the fastest possible edges
+            yield dut.input.eq(rng.getrandbits(n) if k % 50 < 40
+                               else (k & 1) * (2**n - 1))
+            yield dut.latch.eq(k % 100 == 70)
+            if k == 300:
+                yield dut.enable.eq(0)
+            if k == 350:
+                yield dut.enable.eq(1)
+            yield
+        yield dut.latch.eq(0)
+        for _ in range(2 * n + 4):
+            yield
+        yield from compare()
+
+    sim.add_clock(1e-8)
+    sim.add_sync_process(proc)
+    sim.run()
+
+def sim_sync():
+    dut = CounterSync("ch0", 12)
+    m = Module()
+    m.domains.sync = ClockDomain()
+    m.domains.fast = ClockDomain()
+    m.submodules.dut = dut
+    sim = Simulator(m)
+
+    def inputs():
+        # 1500 rising edges in the fast domain, below the 12 bit wrap
+        yield Passive()
+        # wait for the synchronised enable
+        for _ in range(20):
+            yield
+        for _ in range(1500):
+            yield dut.input.eq(1)
+            yield
+            yield dut.input.eq(0)
+            yield
+
+    def proc():
+        yield dut.enable.eq(1)
+        last = 0
+        latched = []
+        for k in range(1400):
+            yield
+            count = yield dut.count
+            fast = yield dut.counter.count
+            # never torn: monotonic, at most a few fast edges behind
+            assert last <= count <= fast, (last, count, fast)
+            last = count
+            yield dut.latch.eq(k % 300 == 100)
+            if (yield dut.latched):
+                latched.append(((yield dut.count_latched),
+                                (yield dut.counter.count_latched)))
+        assert len(latched) == 5, latched
+        for sync_value, fast_value in latched:
+            assert sync_value == fast_value, (sync_value, fast_value)
+        assert last > 1000
+        for _ in range(300):
+            yield
+        assert (yield dut.count) == (yield dut.counter.count) == 1500
+
+    sim.add_clock(1/100e6, domain="sync")
+    sim.add_clock(1/250e6, domain="fast")
+    sim.add_sync_process(inputs, domain="fast")
+    sim.add_sync_process(proc)
+    sim.run()
+
+def sim_snapshot():
+    from register_list import RegisterTable
+
+    snapshot = CounterSnapshot()
+    count_sync = Signal(32)
+    count_fast = Signal(32)
+    count_fast2 = Signal(16)
+    snapshot.add(count_sync)
+    snapshot.add(count_fast, "fast")
+    snapshot.add(count_fast2, "fast")
+    table = RegisterTable("counters")
+    regs = snapshot.add_registers(table, "snap", 0x40)
+
+    m = Module()
+    m.domains.sync = ClockDomain()
+    m.domains.fast = ClockDomain()
+    m.submodules.snapshot = snapshot
+    m.d.sync += count_sync.eq(count_sync + 1)
+    m.d.fast += [
+        count_fast.eq(count_fast + 1),
+        count_fast2.eq(count_fast2 + 3)
+    ]
+
+    sim = Simulator(m)
+
+    def proc():
+        for _ in range(10):
+            yield
+        for n in range(3):
+            # value of the counter in the cycle the strobe is high
+            expected = (yield count_sync) + 1
+            if n == 1:
+                yield regs["snapshot"].signal.eq(1)
+            else:
+                yield snapshot.strobe.eq(1)
+            yield
+            yield regs["snapshot"].signal.eq(0)
+            yield snapshot.strobe.eq(0)
+            yield
+            assert (yield snapshot.ready) == 0
+            for _ in range(10):
+                yield
+            assert (yield snapshot.ready) == 1
+            assert (yield regs["count_sync"].signal) == expected
+            fast = yield regs["count_fast"].signal
+            fast2 = yield regs["count_fast2"].signal
+            # fast runs at 2.5 times the sync clock, the strobe arrives
+            # there within a few sync cycles
+            assert expected * 2.5 <= fast <= (expected + 4) * 2.5, \
+                (expected, fast)
+            # both fast counters are taken in the same fast cycle
+            assert fast2 == (3 * fast) & 0xffff, (fast, fast2)
+            for _ in range(20):
+                yield
+            assert (yield regs["count_fast"].signal) == fast
+
+    sim.add_clock(1/100e6, domain="sync")
+    sim.add_clock(1/250e6, domain="fast")
+    sim.add_sync_process(proc)
+    sim.run()
+
 if __name__ == '__main__':
     dut = Counter()
     sim = Simulator(dut)
@@ -116,4 +690,10 @@ if __name__ == '__main__':
     with sim.write_vcd('counter.vcd', 'counter.gtkw'):
         sim.run()
 
-
+    sim_sync()
+    sim_snapshot()
+    sim_rate()
+    sim_bank()
+    sim_bank(n=5, rising=True, falling=True)
+    sim_bank(n=1)
+    sim_bank(n=2)
@@ -2,18 +2,61 @@
 # This file was imported from https://github.com/kbob/nmigen-examples
 # Changes:
 #   * variable baudrate via external signal
+#   * fractional baudrate divisor (divisor_frac)
+#   * BufferedUART with TX/RX FIFOs and overrun/underrun flags
+#   * UARTWideTx, TX taking multi-byte words from a stream
 
 from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
 
 #from nmigen_lib.util import delay
 #from nmigen_lib.util.main import Main
 
 
+# The bit period is divisor + divisor_frac / 2**frac_bits clock cycles. The
+# fractional part is accumulated, every bit that overflows the accumulator
+# is one cycle longer. E.g. 3 Mbaud from 100 MHz: divisor = 33,
+# divisor_frac = 85 with frac_bits = 8.
+#
+# FracDivider keeps the accumulator for UARTTx, UARTRx and UARTWideTx.
+# 'period' is the count for the next bit, divisor - 2 plus the overflow of
+# the accumulator. A pulse on 'step' moves the accumulator on to the bit
+# after it, 'restart' clears it.
+
+class FracDivider(Elaboratable):
+
+    def __init__(self, frac_bits=8, divisor_max=1 << 16):
+        self.frac_bits = frac_bits
+        self.divisor = Signal(range(divisor_max))
+        self.divisor_frac = Signal(frac_bits)
+        self.period = Signal(range(-1, divisor_max - 1))
+        self.step = Signal()
+        self.restart = Signal()
+
+    def elaborate(self, platform):
+        acc = Signal(self.frac_bits)
+        acc_next = Signal(self.frac_bits)
+        carry = Signal()
+
+        m = Module()
+        m.d.comb += [
+            Cat(acc_next, carry).eq(acc + self.divisor_frac),
+            self.period.eq(self.divisor - 2 + carry),
+        ]
+        with m.If(self.restart):
+            m.d.sync += acc.eq(0)
+        with m.Elif(self.step):
+            m.d.sync += acc.eq(acc_next)
+        return m
+
+
 class UART(Elaboratable):
 
-    def __init__(self, data_bits=8):
+    def __init__(self, data_bits=8, frac_bits=8):
         self.divisor = Signal(16, reset=-1)
+        self.divisor_frac = Signal(frac_bits)
         self.data_bits = data_bits
+        self.frac_bits = frac_bits
 
         self.tx_data = Signal(data_bits)
         self.tx_pin = Signal()
@@ -41,18 +84,20 @@ class UART(Elaboratable):
 
     def elaborate(self, platform):
         m = Module()
-        tx = UARTTx(data_bits=self.data_bits)
-        rx = UARTRx(data_bits=self.data_bits)
+        tx = UARTTx(data_bits=self.data_bits, frac_bits=self.frac_bits)
+        rx = UARTRx(data_bits=self.data_bits, frac_bits=self.frac_bits)
         m.submodules.tx = tx
         m.submodules.rx = rx
         m.d.comb += [
             tx.divisor.eq(self.divisor),
+            tx.divisor_frac.eq(self.divisor_frac),
             tx.tx_data.eq(self.tx_data),
             tx.tx_trg.eq(self.tx_trg),
             self.tx_rdy.eq(tx.tx_rdy),
             self.tx_pin.eq(tx.tx_pin),
 
             rx.divisor.eq(self.divisor),
+            rx.divisor_frac.eq(self.divisor_frac),
             rx.rx_pin.eq(self.rx_pin),
             self.rx_rdy.eq(rx.rx_rdy),
             self.rx_err.eq(rx.rx_err),
@@ -64,10 +109,12 @@ class UART(Elaboratable):
 
 class UARTTx(Elaboratable):
 
-    def __init__(self, data_bits=8):
+    def __init__(self, data_bits=8, frac_bits=8):
         self.divisor_max = (1 << 16)
         self.divisor = Signal(16, reset=-1)
+        self.divisor_frac = Signal(frac_bits)
         self.data_bits = data_bits
+        self.frac_bits = frac_bits
         self.tx_data = Signal(data_bits)
         self.tx_trg = Signal()
         self.tx_rdy = Signal()
@@ -83,8 +130,16 @@ class UARTTx(Elaboratable):
         tx_data = Signal(self.data_bits)
         tx_fast_count = Signal(range(-1, self.divisor_max - 1), reset=-1)
         tx_bit_count = Signal(range(-1, self.data_bits))
+        tx_period = Signal.like(tx_fast_count)
 
         m = Module()
+        m.submodules.frac = frac = FracDivider(self.frac_bits,
+                                               self.divisor_max)
+        m.d.comb += [
+            frac.divisor.eq(self.divisor),
+            frac.divisor_frac.eq(self.divisor_frac),
+            tx_period.eq(frac.period),
+        ]
 
         with m.If(tx_fast_count[-1]):
             with m.FSM():
@@ -95,8 +150,9 @@ class UARTTx(Elaboratable):
                             self.tx_rdy.eq(False),
                             self.tx_pin.eq(0),  # start bit
                             tx_bit_count.eq(self.data_bits - 1),
-                            tx_fast_count.eq(self.divisor - 2),
+                            tx_fast_count.eq(tx_period),
                         ]
+                        m.d.comb += frac.step.eq(1)
                         m.next = 'DATA'
                     with m.Else():
                         m.d.sync += [
@@ -109,16 +165,18 @@ class UARTTx(Elaboratable):
                         m.d.sync += [
                             self.tx_rdy.eq(False),
                             self.tx_pin.eq(1),  # stop bit
-                            tx_fast_count.eq(self.divisor - 2),
+                            tx_fast_count.eq(tx_period),
                         ]
+                        m.d.comb += frac.step.eq(1)
                         m.next = 'STOP'
                     with m.Else():
                         m.d.sync += [
                             self.tx_pin.eq(tx_data[0]),
                             tx_data.eq(tx_data[1:]),
                             tx_bit_count.eq(tx_bit_count - 1),
-                            tx_fast_count.eq(self.divisor - 2),
+                            tx_fast_count.eq(tx_period),
                         ]
+                        m.d.comb += frac.step.eq(1)
                         m.next = 'DATA'
                 with m.State('STOP'):
                     m.d.sync += [
@@ -138,11 +196,13 @@ class UARTTx(Elaboratable):
 
 class UARTRx(Elaboratable):
 
-    def __init__(self, data_bits=8):
+    def __init__(self, data_bits=8, frac_bits=8):
         """Assume no parity, 1 stop bit"""
         self.divisor_max = (1 << 16)
         self.divisor = Signal(16, reset=-1)
+        self.divisor_frac = Signal(frac_bits)
         self.data_bits = data_bits
+        self.frac_bits = frac_bits
         self.rx_pin = Signal(reset=1)
         self.rx_rdy = Signal()
         self.rx_err = Signal()
@@ -167,8 +227,16 @@ class UARTRx(Elaboratable):
         rx_resync_counter = Signal(range(-1, rx_resync_max + 1))
         rx_pin = Signal(reset=1)
         rx_pin1 = Signal(reset=1)
+        rx_period = Signal.like(rx_counter)
 
         m = Module()
+        m.submodules.frac = frac = FracDivider(self.frac_bits,
+                                               self.divisor_max)
+        m.d.comb += [
+            frac.divisor.eq(self.divisor),
+            frac.divisor_frac.eq(self.divisor_frac),
+            rx_period.eq(frac.period),
+        ]
         m.d.comb += self.dbg[0].eq(rx_counter[-1])  # XXX
         m.d.sync += [
             rx_pin.eq(rx_pin1),
@@ -184,6 +252,7 @@ class UARTRx(Elaboratable):
                             self.rx_err.eq(False),
                             rx_counter.eq(self.divisor // 2 - 2),
                         ]
+                        m.d.comb += frac.restart.eq(1)
                         m.next = 'START'
                     with m.Else():
                         m.d.sync += [
@@ -203,14 +272,16 @@ class UARTRx(Elaboratable):
                     with m.Else():
                         m.d.sync += [
                             rx_bits.eq(self.data_bits - 2),
-                            rx_counter.eq(self.divisor - 2),
+                            rx_counter.eq(rx_period),
                         ]
+                        m.d.comb += frac.step.eq(1)
                         m.next = 'DATA'
                 with m.State('DATA'):
                     m.d.sync += [
                         rx_data.eq(Cat(rx_data[1:], rx_pin)),
-                        rx_counter.eq(self.divisor - 2),
+                        rx_counter.eq(rx_period),
                     ]
+                    m.d.comb += frac.step.eq(1)
                     with m.If(rx_bits[-1]):
                         m.next = 'STOP'
                     with m.Else():
@@ -260,6 +331,201 @@ class UARTRx(Elaboratable):
         return m
 
 
+# UART with a FIFO on each side.
+#
+# TX: a byte is written with a pulse on tx_trg while tx_rdy is high, tx_rdy
+# stays high as long as the TX FIFO has room. A write to a full FIFO is
+# dropped and sets tx_overrun.
+# RX: rx_rdy is high while the RX FIFO holds a byte, rx_data shows the
+# oldest one and a pulse on rx_ack removes it. A byte received while the
+# FIFO is full is dropped and sets rx_overrun, rx_ack on an empty FIFO sets
+# rx_underrun. The flags are sticky until a pulse on clear.
+
+class BufferedUART(Elaboratable):
+
+    def __init__(self, data_bits=8, tx_depth=16, rx_depth=16, frac_bits=8):
+        self.divisor = Signal(16, reset=-1)
+        self.divisor_frac = Signal(frac_bits)
+        self.data_bits = data_bits
+        self.tx_depth = tx_depth
+        self.rx_depth = rx_depth
+        self.frac_bits = frac_bits
+
+        self.tx_data = Signal(data_bits)
+        self.tx_pin = Signal()
+        self.tx_trg = Signal()
+        self.tx_rdy = Signal()
+        self.tx_level = Signal(range(tx_depth + 1))
+        self.tx_overrun = Signal()
+
+        self.rx_pin = Signal(reset=1)
+        self.rx_rdy = Signal()
+        self.rx_ack = Signal()
+        self.rx_err = Signal()
+        self.rx_data = Signal(data_bits)
+        self.rx_level = Signal(range(rx_depth + 1))
+        self.rx_overrun = Signal()
+        self.rx_underrun = Signal()
+
+        self.clear = Signal()
+
+        self.ports = (
+                      self.tx_data,
+                      self.tx_trg,
+                      self.tx_rdy,
+                      self.tx_pin,
+                      self.tx_level,
+                      self.tx_overrun,
+
+                      self.rx_pin,
+                      self.rx_rdy,
+                      self.rx_ack,
+                      self.rx_err,
+                      self.rx_data,
+                      self.rx_level,
+                      self.rx_overrun,
+                      self.rx_underrun,
+
+                      self.clear,
+                     )
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.uart = uart = UART(data_bits=self.data_bits,
+                                        frac_bits=self.frac_bits)
+        m.submodules.tx_fifo = tx_fifo = SyncFIFO(width=self.data_bits,
+                                                  depth=self.tx_depth)
+        m.submodules.rx_fifo = rx_fifo = SyncFIFO(width=self.data_bits,
+                                                  depth=self.rx_depth)
+
+        m.d.comb += [
+            uart.divisor.eq(self.divisor),
+            uart.divisor_frac.eq(self.divisor_frac),
+
+            tx_fifo.w_data.eq(self.tx_data),
+            tx_fifo.w_en.eq(self.tx_trg),
+            self.tx_rdy.eq(tx_fifo.w_rdy),
+            self.tx_level.eq(tx_fifo.level),
+            uart.tx_data.eq(tx_fifo.r_data),
+            uart.tx_trg.eq(tx_fifo.r_rdy & uart.tx_rdy),
+            tx_fifo.r_en.eq(tx_fifo.r_rdy & uart.tx_rdy),
+            self.tx_pin.eq(uart.tx_pin),
+
+            uart.rx_pin.eq(self.rx_pin),
+            rx_fifo.w_data.eq(uart.rx_data),
+            rx_fifo.w_en.eq(uart.rx_rdy),
+            self.rx_err.eq(uart.rx_err),
+            self.rx_data.eq(rx_fifo.r_data),
+            self.rx_rdy.eq(rx_fifo.r_rdy),
+            rx_fifo.r_en.eq(self.rx_ack),
+            self.rx_level.eq(rx_fifo.level),
+        ]
+
+        with m.If(self.clear):
+            m.d.sync += [
+                self.tx_overrun.eq(0),
+                self.rx_overrun.eq(0),
+                self.rx_underrun.eq(0),
+            ]
+        with m.Else():
+            with m.If(self.tx_trg & ~tx_fifo.w_rdy):
+                m.d.sync += self.tx_overrun.eq(1)
+            with m.If(uart.rx_rdy & ~rx_fifo.w_rdy):
+                m.d.sync += self.rx_overrun.eq(1)
+            with m.If(self.rx_ack & ~rx_fifo.r_rdy):
+                m.d.sync += self.rx_underrun.eq(1)
+        return m
+
+
+# UART TX that takes words of word_bytes bytes from a stream (data, n,
+# valid, ready). n is the number of valid bytes in the word, starting with
+# the lowest byte. A word is accepted with valid & ready into a holding
+# register and is loaded into the shift register with the start and stop
+# bits of all its bytes the moment the previous word's last stop bit ends,
+# so there are no idle bit periods between bytes as long as the stream
+# keeps up.
+
+class UARTWideTx(Elaboratable):
+
+    def __init__(self, word_bytes=4, frac_bits=8):
+        self.divisor_max = (1 << 16)
+        self.divisor = Signal(16, reset=-1)
+        self.divisor_frac = Signal(frac_bits)
+        self.word_bytes = word_bytes
+        self.frac_bits = frac_bits
+        self.data = Signal(8 * word_bytes)
+        self.n = Signal(range(word_bytes + 1), reset=word_bytes)
+        self.valid = Signal()
+        self.ready = Signal()
+        self.busy = Signal()
+        self.tx_pin = Signal(reset=1)
+        self.ports = (
+                      self.data,
+                      self.n,
+                      self.valid,
+                      self.ready,
+                      self.busy,
+                      self.tx_pin,
+        )
+
+    def elaborate(self, platform):
+        n_bits = 10 * self.word_bytes
+        hold = Signal.like(self.data)
+        hold_n = Signal.like(self.n)
+        hold_valid = Signal()
+        shift = Signal(n_bits, reset=-1)
+        bits_left = Signal(range(n_bits + 1))
+        tx_fast_count = Signal(range(-1, self.divisor_max - 1), reset=-1)
+        tx_period = Signal.like(tx_fast_count)
+
+        m = Module()
+        m.submodules.frac = frac = FracDivider(self.frac_bits,
+                                               self.divisor_max)
+        m.d.comb += [
+            frac.divisor.eq(self.divisor),
+            frac.divisor_frac.eq(self.divisor_frac),
+            tx_period.eq(frac.period),
+            self.ready.eq(~hold_valid),
+            self.busy.eq(hold_valid | (bits_left != 0)),
+            self.tx_pin.eq(shift[0]),
+        ]
+
+        with m.If(self.valid & ~hold_valid):
+            m.d.sync += [
+                hold.eq(self.data),
+                hold_n.eq(self.n),
+                hold_valid.eq(1),
+            ]
+
+        with m.If(tx_fast_count[-1]):
+            with m.If(bits_left > 1):
+                m.d.sync += [
+                    shift.eq(Cat(shift[1:], 1)),
+                    bits_left.eq(bits_left - 1),
+                    tx_fast_count.eq(tx_period),
+                ]
+                m.d.comb += frac.step.eq(1)
+            with m.Elif(hold_valid):
+                # start bit, data bits, stop bit of every byte
+                m.d.sync += [
+                    shift.eq(Cat(*[Cat(Const(0, 1), hold.word_select(i, 8),
+                                       Const(1, 1))
+                                   for i in range(self.word_bytes)])),
+                    bits_left.eq(hold_n * 10),
+                    hold_valid.eq(0),
+                    tx_fast_count.eq(tx_period),
+                ]
+                m.d.comb += frac.step.eq(1)
+            with m.Else():
+                m.d.sync += [
+                    shift.eq(-1),
+                    bits_left.eq(0),
+                ]
+        with m.Else():
+            m.d.sync += tx_fast_count.eq(tx_fast_count - 1)
+        return m
+
+
 #if __name__ == '__main__':
 #    divisor = 20
 #    design = UART()
@@ -306,3 +572,89 @@ class UARTRx(Elaboratable):
 #                yield design.rx_pin.eq(1)
 #                yield from delay(divisor)
 #                yield from delay(2)
+
+
+
+def sim_buffered(divisor=33, divisor_frac=85, frac_bits=8):
+    from amaranth.sim import Simulator, Passive
+
+    # TX looped back to RX
+    dut = BufferedUART(tx_depth=8, rx_depth=4, frac_bits=frac_bits)
+    m = Module()
+    m.submodules.dut = dut
+    m.d.comb += dut.rx_pin.eq(dut.tx_pin)
+
+    sim = Simulator(m)
+    data = [0x55, 0x00, 0xff, 0x95, 0x01, 0x80, 0x3c]
+    period = divisor + divisor_frac / (1 << frac_bits)
+    monitored = []
+
+    def monitor():
+        # checks every bit against the ideal (fractional) bit period, all
+        # bits of a frame have to be stable apart from 1 cycle at the edges
+        yield Passive()
+        while True:
+            yield
+            if (yield dut.tx_pin) == 0:
+                bits = []
+                t = 1
+                for k in range(10):
+                    values = set()
+                    while t < (k + 1) * period - 1:
+                        if t > k * period + 1:
+                            values.add((yield dut.tx_pin))
+                        yield
+                        t += 1
+                    assert len(values) == 1, (k, values)
+                    bits.append(values.pop())
+                assert bits[0] == 0 and bits[9] == 1, bits
+                monitored.append(sum(b << i for i, b in enumerate(bits[1:9])))
+
+    def proc():
+        yield dut.divisor.eq(divisor)
+        yield dut.divisor_frac.eq(divisor_frac)
+        yield
+        # all bytes are buffered at once
+        for c in data:
+            assert (yield dut.tx_rdy) == 1
+            yield dut.tx_data.eq(c)
+            yield dut.tx_trg.eq(1)
+            yield
+        yield dut.tx_trg.eq(0)
+        for _ in range(int(12 * period * len(data))):
+            yield
+        assert monitored == data, monitored
+        assert (yield dut.tx_level) == 0
+        assert (yield dut.tx_overrun) == 0
+        # the RX FIFO holds 4 bytes, the rest is lost
+        assert (yield dut.rx_overrun) == 1
+        received = []
+        while (yield dut.rx_rdy):
+            received.append((yield dut.rx_data))
+            yield dut.rx_ack.eq(1)
+            yield
+            yield dut.rx_ack.eq(0)
+            yield
+        assert received == data[:4], received
+        assert (yield dut.rx_underrun) == 0
+        yield dut.rx_ack.eq(1)
+        yield
+        yield dut.rx_ack.eq(0)
+        yield
+        assert (yield dut.rx_underrun) == 1
+        yield dut.clear.eq(1)
+        yield
+        yield dut.clear.eq(0)
+        yield
+        assert (yield dut.rx_overrun) == 0
+        assert (yield dut.rx_underrun) == 0
+
+    sim.add_clock(1e-8)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(monitor)
+    sim.run()
+
+
+if __name__ == '__main__':
+    sim_buffered()
+    sim_buffered(divisor=8, divisor_frac=0)
@@ -0,0 +1,240 @@
+import json
+import os
+import numpy as np
+
+from hit_decoder import HIT_DTYPE
+
+# Capture file for decoded hits (see hit_decoder.py), to be opened with
+# np.memmap so long runs load without reading the file.
+#
+# Layout:
+# bytes 0-7: magic b"HITCAP\x00\x01"
+# bytes 8-11: length of the JSON header, little endian
+# JSON header: channels ({idx: name}), clocks ({name: Hz}), time_clock (the
+#   clock of the timestamps), bits_time, bits_width
+# zero padding up to a multiple of HEADER_ALIGN
+# records of CAPTURE_DTYPE up to the end of the file
+#
+# The number of records follows from the file size, so a capture that was
+# not closed properly can still be read up to its last complete record.
+#
+# The timestamps of the hardware wrap after bits_time bits. The writer
+# extends them to 64 bit: every hit gets the extended time nearest to the
+# one of the hit before, a step of more than half the range counts as a wrap
+# in either direction. Hits of different channels may be slightly out of
+# order, also across a wrap, as long as they are less than half the range
+# apart.
+#
+# The records are stored sorted by time: the writer sorts its buffer and
+# holds back the hits of the last half range, a later hit can still go in
+# front of them. A hit older than the hits already written is rejected with
+# a ValueError. With the times in order, slice() finds a time range by
+# binary search and only touches the pages it returns.
+
+MAGIC = b"HITCAP\x00\x01"
+HEADER_ALIGN = 4096
+
+CAPTURE_DTYPE = np.dtype([("time", "<u8"), ("width", "<u2"), ("idx", "u1")])
+
+def channel_map(channels):
+    # {idx: name} of TdcChannels
+    return {int(ch.idx.reset): ch.name for ch in channels}
+
+def mmcm_clocks(mmcm):
+    # {name: Hz} of the input and the outputs of an MMCME2
+    clocks = {"clkin": mmcm.freq_in}
+    for n, (_, _, freq, _) in enumerate(mmcm.outputs):
+        clocks["clkout{}".format(n)] = freq
+    return clocks
+
+class CaptureWriter():
+    def __init__(self, path, channels=None, clocks=None, time_clock="sync",
+                 bits_time=16, bits_width=16, chunk_hits=1 << 16):
+        self.bits_time = bits_time
+        self.chunk_hits = chunk_hits
+        self.buffer = np.zeros(0, dtype=CAPTURE_DTYPE)
+        self.last_time = None
+        self.max_time = None
+        self.written_time = None
+        self.n_hits = 0
+
+        header = json.dumps({
+            "channels": {str(k): v for k, v in (channels or {}).items()},
+            "clocks": clocks or {},
+            "time_clock": time_clock,
+            "bits_time": bits_time,
+            "bits_width": bits_width
+        }).encode()
+        size = len(MAGIC) + 4 + len(header)
+        padding = -size % HEADER_ALIGN
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + len(header).to_bytes(4, "little") + header +
+                        bytes(padding))
+
+    def unwrap(self, time):
+        # signed steps modulo the range, added to the last extended time
+        time = time.astype(np.int64)
+        if self.last_time is None:
+            self.last_time = time[0]
+        half = 1 << (self.bits_time - 1)
+        prev = np.concatenate([[self.last_time % (2 * half)], time[:-1]])
+        steps = (time - prev + half) % (2 * half) - half
+        extended = self.last_time + np.cumsum(steps)
+        self.last_time = int(extended[-1])
+        return extended
+
+    def write(self, hits):
+        if len(hits) == 0:
+            return
+        last_time = self.last_time
+        records = np.empty(len(hits), dtype=CAPTURE_DTYPE)
+        records["time"] = self.unwrap(hits["time"])
+        records["width"] = hits["width"]
+        records["idx"] = hits["idx"]
+        oldest = int(records["time"].min())
+        if self.written_time is not None and oldest < self.written_time:
+            self.last_time = last_time
+            raise ValueError("hit at {} is older than the hits written up to "
+                             "{}".format(oldest, self.written_time))
+        newest = int(records["time"].max())
+        if self.max_time is None or newest > self.max_time:
+            self.max_time = newest
+        self.buffer = np.concatenate([self.buffer, records])
+        self.n_hits += len(records)
+        if len(self.buffer) >= self.chunk_hits:
+            self.flush()
+
+    def flush(self, final=False):
+        # writes the buffer sorted by time, except for the hits that a later
+        # hit could still go in front of, unless final
+        records = self.buffer[np.argsort(self.buffer["time"], kind="stable")]
+        if final:
+            n = len(records)
+        else:
+            limit = self.max_time - (1 << (self.bits_time - 1))
+            n = int(np.searchsorted(records["time"], limit, side="right"))
+        if n > 0:
+            self.file.write(records[:n].tobytes())
+            self.written_time = int(records["time"][n - 1])
+        self.buffer = records[n:]
+        self.file.flush()
+
+    def close(self):
+        self.flush(final=True)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CaptureFile():
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise IOError("{} is not a hit capture file".format(path))
+            length = int.from_bytes(f.read(4), "little")
+            header = json.loads(f.read(length))
+        self.channels = {int(k): v for k, v in header["channels"].items()}
+        self.clocks = header["clocks"]
+        self.time_clock = header["time_clock"]
+        self.bits_time = header["bits_time"]
+        self.bits_width = header["bits_width"]
+
+        size = len(MAGIC) + 4 + length
+        offset = size + (-size % HEADER_ALIGN)
+        n = (os.path.getsize(path) - offset) // CAPTURE_DTYPE.itemsize
+        if n > 0:
+            self.hits = np.memmap(path, dtype=CAPTURE_DTYPE, mode="r",
+                                  offset=offset, shape=(n,))
+        else:
+            self.hits = np.zeros(0, dtype=CAPTURE_DTYPE)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def slice(self, start, end):
+        # hits with start <= time < end, in units of time_clock cycles
+        i, j = np.searchsorted(self.hits["time"], [start, end])
+        return self.hits[i:j]
+
+    def seconds(self, time):
+        return time / self.clocks[self.time_clock]
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    rng = np.random.default_rng(1)
+    n = 200000
+    steps = rng.integers(0, 200, n)
+    times = np.cumsum(steps)
+    hits = np.empty(n, dtype=HIT_DTYPE)
+    hits["time"] = times & 0xffff
+    hits["width"] = rng.integers(0, 1 << 16, n)
+    hits["idx"] = rng.integers(0, 4, n)
+    channels = {0: "ch0", 1: "ch1", 2: "trigger", 3: "veto"}
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "run.hits")
+        with CaptureWriter(path, channels, {"sync": 100e6, "fast": 250e6},
+                           chunk_hits=10000) as writer:
+            for chunk in np.array_split(hits, 37):
+                writer.write(chunk)
+
+        capture = CaptureFile(path)
+        assert capture.channels == channels
+        assert capture.clocks["fast"] == 250e6
+        assert capture.bits_time == 16
+        assert len(capture) == n
+        assert (capture.hits["time"] == times).all()
+        assert (capture.hits["width"] == hits["width"]).all()
+        assert (capture.hits["idx"] == hits["idx"]).all()
+
+        part = capture.slice(100000, 200000)
+        assert (part["time"] == times[(times >= 100000) &
+                                      (times < 200000)]).all()
+        assert capture.seconds(part["time"][0]) >= 1e-3
+
+        # out of order across a wrap, also at a chunk boundary
+        out_of_order = os.path.join(d, "wrap.hits")
+        wrapped = np.zeros(4, dtype=HIT_DTYPE)
+        wrapped["time"] = [65530, 5, 65532, 7]
+        with CaptureWriter(out_of_order) as writer:
+            writer.write(wrapped[:2])
+            writer.write(wrapped[2:])
+        times_wrapped = CaptureFile(out_of_order).hits["time"]
+        assert list(times_wrapped) == [65530, 65532, 65541, 65543]
+
+        # interleaved channels are stored in order, so slice() finds them
+        interleaved = os.path.join(d, "interleaved.hits")
+        mixed = np.zeros(6, dtype=HIT_DTYPE)
+        mixed["time"] = [100, 90, 200, 190, 300, 290]
+        mixed["idx"] = [0, 1, 0, 1, 0, 1]
+        with CaptureWriter(interleaved, chunk_hits=2) as writer:
+            for i in range(0, 6, 2):
+                writer.write(mixed[i:i + 2])
+        capture_mixed = CaptureFile(interleaved)
+        assert list(capture_mixed.hits["time"]) == [90, 100, 190, 200, 290, 300]
+        assert list(capture_mixed.hits["idx"]) == [1, 0, 1, 0, 1, 0]
+        assert list(capture_mixed.slice(95, 195)["time"]) == [100, 190]
+
+        # a hit behind the written ones is rejected
+        late = os.path.join(d, "late.hits")
+        behind = np.zeros(5, dtype=HIT_DTYPE)
+        behind["time"] = [100, 30000, 40000, 20000, 70]
+        with CaptureWriter(late, chunk_hits=1) as writer:
+            writer.write(behind[:4])
+            try:
+                writer.write(behind[4:])
+                assert False
+            except ValueError:
+                pass
+        assert list(CaptureFile(late).hits["time"]) == [100, 20000, 30000, 40000]
+
+        # a record cut short at the end is ignored
+        with open(path, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        assert len(CaptureFile(path)) == n
@@ -0,0 +1,147 @@
+import numpy as np
+
+# Host side decoder for the FRAME_SINGLE records of HitSerialiser
+# (see hit_serialiser.py):
+# byte 0: index number
+# bytes 1-4: 32-bit value, little endian
+# byte 5: 0xff
+#
+# The value is split as in TdcChannel.output: width in the lower bits_width
+# bits, timestamp above. decode() takes the bytes as they arrive and returns
+# the complete records as a structured array with the fields idx, time and
+# width. An incomplete record at the end is kept for the next call.
+#
+# The records are found by their 0xff terminator. Data bytes can be 0xff
+# too, so the decoder aligns on the offset with the longest run of valid
+# terminators and stays there while the terminators are valid. After a lost
+# or corrupted byte it aligns again, the skipped bytes are counted in
+# 'errors'. All of this works on NumPy views of the buffer, only a slip
+# costs a step in Python.
+
+FRAME_BYTES = 6
+FRAME_END = 0xff
+
+FRAME_DTYPE = np.dtype([("idx", "u1"), ("value", "<u4"), ("end", "u1")])
+HIT_DTYPE = np.dtype([("idx", "u1"), ("time", "<u4"), ("width", "<u2")])
+
+class HitDecoder():
+    def __init__(self, bits_width=16, align_window=64):
+        self.bits_width = bits_width
+        # number of records looked at to find the alignment
+        self.align_window = align_window
+        self.rest = b""
+        self.aligned = False
+        self.errors = 0
+
+    def align(self, a, pos):
+        # returns the offset from pos with the longest run of valid records,
+        # None if there are not enough bytes to decide
+        runs = []
+        for p in range(FRAME_BYTES):
+            ends = a[pos + p + FRAME_BYTES - 1::FRAME_BYTES]
+            ok = ends[:self.align_window] == FRAME_END
+            runs.append(len(ok) if ok.all() else int(np.argmin(ok)))
+        if len(a) - pos < 2 * FRAME_BYTES - 1:
+            # not every offset has a full record yet
+            return None
+        best = int(np.argmax(runs))
+        if runs[best] == 0:
+            # no terminator in the next record, none of it can be a start
+            return FRAME_BYTES
+        return best
+
+    def frames(self, data):
+        buf = self.rest + bytes(data)
+        a = np.frombuffer(buf, dtype=np.uint8)
+        pos = 0
+        segments = []
+        while len(a) - pos >= FRAME_BYTES:
+            if not self.aligned:
+                skip = self.align(a, pos)
+                if skip is None:
+                    break
+                self.errors += skip
+                pos += skip
+                self.aligned = skip < FRAME_BYTES
+                continue
+            n = (len(a) - pos) // FRAME_BYTES
+            ok = a[pos + FRAME_BYTES - 1::FRAME_BYTES][:n] == FRAME_END
+            good = n if ok.all() else int(np.argmin(ok))
+            if good:
+                segments.append(np.frombuffer(buf, dtype=FRAME_DTYPE,
+                                              count=good, offset=pos))
+                pos += good * FRAME_BYTES
+            if good < n:
+                self.aligned = False
+        self.rest = buf[pos:]
+        if not segments:
+            return np.zeros(0, dtype=FRAME_DTYPE)
+        return np.concatenate(segments)
+
+    def decode(self, data):
+        frames = self.frames(data)
+        hits = np.empty(len(frames), dtype=HIT_DTYPE)
+        value = frames["value"]
+        hits["idx"] = frames["idx"]
+        hits["time"] = value >> self.bits_width
+        hits["width"] = value & ((1 << self.bits_width) - 1)
+        return hits
+
+def decode_hits(data, bits_width=16):
+    return HitDecoder(bits_width).decode(data)
+
+def encode_hits(hits, bits_width=16):
+    # the byte stream HitSerialiser sends for 'hits', for tests
+    frames = np.empty(len(hits), dtype=FRAME_DTYPE)
+    frames["idx"] = hits["idx"]
+    frames["value"] = ((hits["time"].astype(np.uint32) << bits_width) |
+                       hits["width"])
+    frames["end"] = FRAME_END
+    return frames.tobytes()
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(1)
+    n = 100000
+    hits = np.empty(n, dtype=HIT_DTYPE)
+    hits["idx"] = rng.integers(0, 256, n)
+    hits["time"] = rng.integers(0, 1 << 16, n)
+    hits["width"] = rng.integers(0, 1 << 16, n)
+    # terminators inside the records
+    hits["idx"][::7] = 0xff
+    hits["width"][::5] = 0xffff
+    data = encode_hits(hits)
+
+    assert (decode_hits(data) == hits).all()
+
+    # streaming in odd chunks, starting in the middle of a record
+    decoder = HitDecoder()
+    out = []
+    cuts = np.sort(rng.integers(3, len(data), 500))
+    starts = np.concatenate([[3], cuts])
+    ends = np.concatenate([cuts, [len(data)]])
+    for a, b in zip(starts, ends):
+        out.append(decoder.decode(data[a:b]))
+    out = np.concatenate(out)
+    assert (out == hits[1:]).all()
+    assert decoder.errors == 3
+    assert decoder.rest == b""
+
+    # a lost byte and a corrupted terminator cost only the broken records
+    broken = bytearray(data)
+    del broken[6 * 1002 + 2]
+    broken[6 * 5000 + 5 - 1] = 0x00
+    decoder = HitDecoder()
+    out = decoder.decode(broken)
+    good = np.ones(n, dtype=bool)
+    good[[1002, 5000]] = False
+    assert (out == hits[good]).all()
+    assert decoder.errors == 5 + 6
+
+    t = time.perf_counter()
+    for _ in range(10):
+        decode_hits(data)
+    rate = 10 * n / (time.perf_counter() - t)
+    print("decoded {:.1f} Mhits/s".format(rate / 1e6))
@@ -1,25 +1,90 @@
 from amaranth import *
 from amaranth.sim import *
+from amaranth.lib.memory import Memory
+
+from cobs import CobsEncoder, cobs_decode
+from external.uart import UARTWideTx
 
 # this encoder transfors sequences of hits into bytes for UART transmission.
 # it is connected to a FIFO on the input and a UART TX on the output and will
 # send the transformed sequence on the wire.
 
-# Output format is:
+# Output format (FRAME_SINGLE) is:
 # byte 0: index number
 # bytes 1-4: 32-bit value
 # byte 5: 0xff
+#
+# With word_bytes set, FRAME_SINGLE records are sent as words of word_bytes
+# bytes on a stream (word, word_n, word_valid, word_rdy) instead of the tx
+# byte handshake, for a wide UART TX like UARTWideTx in external/uart.py.
+# The byte sequence is the same, the last word of a record holds the
+# remaining word_n bytes.
+
+# Output format (FRAME_PACKET) is:
+# byte 0: 0xfe (packet header)
+# byte 1: number of hits n in the packet (1..max_hits)
+# n times:
+#   byte 0: index number
+#   bytes 1-4: 32-bit value
+# last byte: 0xff
+#
+# In packet mode, up to max_hits hits are drained from the FIFO (using
+# fifo_r_en) before the packet is sent. Bytes are handed to the UART as soon
+# as tx_rdy is high, so consecutive bytes leave the UART back to back.
+
+# Output format (FRAME_DELTA) is a variable length record per hit:
+# byte 0: bit 0-6: index number, bit 7: sync flag
+# sync record:
+#   bytes: full timestamp, little endian
+# delta record:
+#   bytes: varint of timestamp - previous timestamp of the same index number
+# bytes: varint of the width
+#
+# Varints are little endian groups of 7 bit, bit 7 is set on all but the
+# last byte. The value is split as in TdcChannel.output: width in the lower
+# 16 bits, timestamp above. Index numbers must be below n_channels. The
+# first hit of every index number, and every index number after sync_interval
+# hits in total, is sent as a sync record.
+
+# With cobs=True, every packet (FRAME_PACKET) or record (FRAME_DELTA) is
+# COBS encoded and terminated by 0x00, see cobs.py. The host can then split
+# the stream at zero bytes and resynchronise after a lost byte.
+
+FRAME_SINGLE = "single"
+FRAME_PACKET = "packet"
+FRAME_DELTA = "delta"
+
+PACKET_HEADER = 0xfe
+PACKET_TRAILER = 0xff
 
 class HitSerialiser(Elaboratable):
-    def __init__(self, bits=32, n_bytes=6):
+    def __init__(self, bits=32, n_bytes=6, framing=FRAME_SINGLE, max_hits=16,
+                 n_channels=8, sync_interval=256, cobs=False, word_bytes=0):
+        assert(not cobs or framing != FRAME_SINGLE), \
+            "COBS framing needs FRAME_PACKET or FRAME_DELTA"
+        assert(not word_bytes or framing == FRAME_SINGLE), \
+            "word output needs FRAME_SINGLE"
         self.bits = bits
         self.n_bytes = n_bytes
+        self.framing = framing
+        self.cobs = cobs
+        self.word_bytes = word_bytes
+        self.max_hits = max_hits
+        self.n_channels = n_channels
+        self.sync_interval = sync_interval
+        self.bits_width = 16
+        self.bits_time = self.bits - self.bits_width
         self.fifo_rdy = Signal()
+        self.fifo_r_en = Signal()
         self.fifo_r_data = Signal(self.bits)
         self.rdy = Signal()
         self.tx = Signal(unsigned(8))
         self.tx_rdy = Signal()
         self.tx_trg = Signal()
+        self.word = Signal(8 * max(word_bytes, 1))
+        self.word_n = Signal(range(max(word_bytes, 1) + 1))
+        self.word_valid = Signal()
+        self.word_rdy = Signal()
         self.idx = Signal(8)
         self.latch = Signal()
 
@@ -29,6 +94,7 @@ class HitSerialiser(Elaboratable):
 
         self.ports = [
             self.fifo_rdy,
+            self.fifo_r_en,
             self.rdy,
             self.tx,
             self.tx_rdy,
@@ -36,6 +102,11 @@ class HitSerialiser(Elaboratable):
         ]
 
     def elaborate(self, platform):
+        if self.framing != FRAME_SINGLE:
+            return self.elaborate_stream(platform)
+        if self.word_bytes:
+            return self.elaborate_words(platform)
+
         m = Module()
 
         data = Signal(self.bits)
@@ -50,6 +121,7 @@ class HitSerialiser(Elaboratable):
             with m.State("IDLE"):
                 m.d.sync += pos.eq(0)
                 with m.If(self.fifo_rdy == 1):
+                    m.d.comb += self.fifo_r_en.eq(1)
                     m.d.sync += [
                         data.eq(self.fifo_r_data),
                         idx.eq(self.idx)
@@ -90,6 +162,485 @@ class HitSerialiser(Elaboratable):
 
         return m
 
+    def elaborate_words(self, platform):
+        m = Module()
+
+        n_words = (self.n_bytes + self.word_bytes - 1) // self.word_bytes
+        record = Signal(8 * self.word_bytes * n_words)
+        pos = Signal(range(n_words))
+
+        with m.FSM(reset="IDLE") as fsm:
+
+            m.d.comb += [
+                self.rdy.eq(fsm.ongoing("IDLE")),
+                self.word_valid.eq(fsm.ongoing("SEND")),
+                self.word.eq(record.word_select(pos, 8 * self.word_bytes)),
+                self.word_n.eq(Mux(pos == n_words - 1,
+                    self.n_bytes - (n_words - 1) * self.word_bytes,
+                    self.word_bytes))
+            ]
+
+            with m.State("IDLE"):
+                m.d.sync += pos.eq(0)
+                with m.If(self.fifo_rdy == 1):
+                    m.d.comb += self.fifo_r_en.eq(1)
+                    m.d.sync += record.eq(Cat(self.idx,
+                        self.fifo_r_data[:8 * (self.n_bytes - 2)],
+                        Const(0xff, 8)))
+                    m.next = "SEND"
+
+            with m.State("SEND"):
+                with m.If(self.word_rdy == 1):
+                    m.d.sync += pos.eq(pos + 1)
+                    with m.If(pos == n_words - 1):
+                        m.d.sync += self.n_transmitted.eq(
+                            self.n_transmitted + 1)
+                        m.next = "IDLE"
+
+        # Latch counter
+        with m.If(self.latch == 1):
+            m.d.sync += self.n_transmitted_latched.eq(self.n_transmitted)
+
+        return m
+
+    def elaborate_stream(self, platform):
+        if self.cobs:
+            tx = Signal(8)
+            tx_trg = Signal()
+            tx_rdy = Signal()
+        else:
+            tx = self.tx
+            tx_trg = self.tx_trg
+            tx_rdy = self.tx_rdy
+        tx_last = Signal()
+
+        if self.framing == FRAME_PACKET:
+            m = self.elaborate_packet(platform, tx, tx_trg, tx_rdy, tx_last)
+        else:
+            m = self.elaborate_delta(platform, tx, tx_trg, tx_rdy, tx_last)
+
+        if self.cobs:
+            m.submodules.cobs = cobs = CobsEncoder()
+            m.d.comb += [
+                cobs.data.eq(tx),
+                cobs.trg.eq(tx_trg),
+                cobs.last.eq(tx_last),
+                tx_rdy.eq(cobs.rdy),
+                self.tx.eq(cobs.tx),
+                self.tx_trg.eq(cobs.tx_trg),
+                cobs.tx_rdy.eq(self.tx_rdy)
+            ]
+
+        return m
+
+    def elaborate_packet(self, platform, tx, tx_trg, tx_rdy, tx_last):
+        m = Module()
+
+        hit_bytes = self.n_bytes - 1
+        n_hits = Signal(range(self.max_hits + 1))
+        hit = Signal(range(self.max_hits))
+        pos = Signal(range(hit_bytes))
+        byte = Signal(8)
+        sending = Signal()
+
+        # hits are stored as index number followed by the value
+        m.submodules.storage = storage = Memory(
+                shape=unsigned(8 * hit_bytes), depth=self.max_hits, init=[])
+        w_port = storage.write_port()
+        r_port = storage.read_port()
+
+        m.d.comb += [
+            w_port.addr.eq(n_hits),
+            w_port.data.eq(Cat(self.idx, self.fifo_r_data)),
+            r_port.addr.eq(hit),
+            tx.eq(byte),
+            tx_trg.eq(sending & tx_rdy)
+        ]
+
+        with m.FSM(reset="IDLE") as fsm:
+
+            m.d.comb += self.rdy.eq(fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                m.d.sync += [
+                    n_hits.eq(0),
+                    hit.eq(0),
+                    pos.eq(0)
+                ]
+                with m.If(self.fifo_rdy == 1):
+                    m.next = "COLLECT"
+
+            with m.State("COLLECT"):
+                with m.If((self.fifo_rdy == 1) & (n_hits < self.max_hits)):
+                    m.d.comb += [
+                        self.fifo_r_en.eq(1),
+                        w_port.en.eq(1)
+                    ]
+                    m.d.sync += n_hits.eq(n_hits + 1)
+                with m.Elif(n_hits == 0):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "HEADER"
+
+            with m.State("HEADER"):
+                m.d.comb += [
+                    byte.eq(PACKET_HEADER),
+                    sending.eq(1)
+                ]
+                with m.If(tx_rdy == 1):
+                    m.next = "COUNT"
+
+            with m.State("COUNT"):
+                m.d.comb += [
+                    byte.eq(n_hits),
+                    sending.eq(1)
+                ]
+                with m.If(tx_rdy == 1):
+                    m.next = "FETCH"
+
+            # one cycle for the memory read port to follow 'hit'
+            with m.State("FETCH"):
+                m.next = "HIT"
+
+            with m.State("HIT"):
+                m.d.comb += [
+                    byte.eq(r_port.data.word_select(pos, 8)),
+                    sending.eq(1)
+                ]
+                with m.If(tx_rdy == 1):
+                    with m.If(pos != hit_bytes - 1):
+                        m.d.sync += pos.eq(pos + 1)
+                    with m.Elif(hit != n_hits - 1):
+                        m.d.sync += [
+                            pos.eq(0),
+                            hit.eq(hit + 1)
+                        ]
+                        m.next = "FETCH"
+                    with m.Else():
+                        m.next = "TRAILER"
+
+            with m.State("TRAILER"):
+                m.d.comb += [
+                    byte.eq(PACKET_TRAILER),
+                    sending.eq(1),
+                    tx_last.eq(1)
+                ]
+                with m.If(tx_rdy == 1):
+                    m.d.sync += self.n_transmitted.eq(
+                        self.n_transmitted + n_hits)
+                    m.next = "IDLE"
+
+        # Latch counter
+        with m.If(self.latch == 1):
+            m.d.sync += self.n_transmitted_latched.eq(self.n_transmitted)
+
+        return m
+
+    def varint(self, m, value, name):
+        # returns the 7 bit groups of value and the number of groups needed
+        groups = (len(value) + 6) // 7
+        padded = Signal(7 * groups, name=name)
+        length = Signal(range(1, groups + 1), name=name + "_len")
+        m.d.comb += [
+            padded.eq(value),
+            length.eq(1)
+        ]
+        for i in range(1, groups):
+            with m.If(value[7 * i:] != 0):
+                m.d.comb += length.eq(i + 1)
+        return padded, length
+
+    def elaborate_delta(self, platform, tx, tx_trg, tx_rdy, tx_last):
+        m = Module()
+
+        time_bytes = (self.bits_time + 7) // 8
+        prev = Array([Signal(self.bits_time, name="prev_time{}".format(i))
+                      for i in range(self.n_channels)])
+        need_sync = Signal(self.n_channels, reset=-1)
+        n_since_sync = Signal(range(self.sync_interval))
+
+        idx = Signal(7)
+        sync = Signal()
+        time = Signal(self.bits_time)
+        width = Signal(self.bits_width)
+        delta = Signal(self.bits_time)
+        pos = Signal(range(max(time_bytes, (self.bits_time + 6) // 7, 3)))
+        byte = Signal(8)
+        sending = Signal()
+        last = Signal()
+
+        delta_groups, delta_len = self.varint(m, delta, "delta_groups")
+        width_groups, width_len = self.varint(m, width, "width_groups")
+        time_padded = Signal(8 * time_bytes)
+
+        m.d.comb += [
+            time_padded.eq(time),
+            tx.eq(byte),
+            tx_trg.eq(sending & tx_rdy)
+        ]
+
+        with m.FSM(reset="IDLE") as fsm:
+
+            m.d.comb += self.rdy.eq(fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                m.d.sync += pos.eq(0)
+                with m.If(self.fifo_rdy == 1):
+                    fifo_time = self.fifo_r_data[self.bits_width:]
+                    m.d.comb += self.fifo_r_en.eq(1)
+                    m.d.sync += [
+                        idx.eq(self.idx),
+                        sync.eq(need_sync.bit_select(self.idx, 1)),
+                        time.eq(fifo_time),
+                        width.eq(self.fifo_r_data[:self.bits_width]),
+                        delta.eq(fifo_time - prev[self.idx])
+                    ]
+                    m.next = "INDEX"
+
+            with m.State("INDEX"):
+                m.d.comb += [
+                    byte.eq(Cat(idx, sync)),
+                    sending.eq(1)
+                ]
+                with m.If(tx_rdy == 1):
+                    m.next = "TIME"
+
+            with m.State("TIME"):
+                with m.If(sync == 1):
+                    m.d.comb += [
+                        byte.eq(time_padded.word_select(pos, 8)),
+                        last.eq(pos == time_bytes - 1)
+                    ]
+                with m.Else():
+                    m.d.comb += [
+                        last.eq(pos == delta_len - 1),
+                        byte.eq(Cat(delta_groups.word_select(pos, 7), ~last))
+                    ]
+                m.d.comb += sending.eq(1)
+                with m.If(tx_rdy == 1):
+                    with m.If(last == 1):
+                        m.d.sync += pos.eq(0)
+                        m.next = "WIDTH"
+                    with m.Else():
+                        m.d.sync += pos.eq(pos + 1)
+
+            with m.State("WIDTH"):
+                m.d.comb += [
+                    last.eq(pos == width_len - 1),
+                    byte.eq(Cat(width_groups.word_select(pos, 7), ~last)),
+                    sending.eq(1),
+                    tx_last.eq(last)
+                ]
+                with m.If(tx_rdy == 1):
+                    with m.If(last == 1):
+                        m.next = "DONE"
+                    with m.Else():
+                        m.d.sync += pos.eq(pos + 1)
+
+            with m.State("DONE"):
+                m.d.sync += [
+                    prev[idx].eq(time),
+                    self.n_transmitted.eq(self.n_transmitted + 1),
+                    n_since_sync.eq(n_since_sync + 1)
+                ]
+                with m.If(n_since_sync == self.sync_interval - 1):
+                    m.d.sync += [
+                        n_since_sync.eq(0),
+                        need_sync.eq(-1)
+                    ]
+                with m.Else():
+                    m.d.sync += need_sync.bit_select(idx, 1).eq(0)
+                m.next = "IDLE"
+
+        # Latch counter
+        with m.If(self.latch == 1):
+            m.d.sync += self.n_transmitted_latched.eq(self.n_transmitted)
+
+        return m
+
+def sim_fifo(dut, hits):
+    # feeds (idx, value) hits to dut like a first-word-fall-through FIFO
+    for idx, value in hits:
+        yield dut.idx.eq(idx)
+        yield dut.fifo_r_data.eq(value)
+        yield dut.fifo_rdy.eq(1)
+        yield
+        while (yield dut.fifo_r_en) == 0:
+            yield
+    yield dut.fifo_rdy.eq(0)
+
+def sim_packet(cobs=False):
+    from serial_encoder import sim_uart
+
+    dut = HitSerialiser(bits=32, n_bytes=6, framing=FRAME_PACKET, max_hits=4,
+                        cobs=cobs)
+
+    sim = Simulator(dut)
+
+    hits = [(0x01, 0x4), (0x01, 0x0a), (0x02, 0x13371337), (0x03, 0xfe),
+            (0x04, 0xabcdef12), (0x05, 0xffffffff)]
+    received = []
+
+    def expect(packet):
+        out = [PACKET_HEADER, len(packet)]
+        for idx, value in packet:
+            out += [idx] + list(value.to_bytes(4, "little"))
+        return out + [PACKET_TRAILER]
+
+    def proc():
+        yield from sim_fifo(dut, hits)
+        for i in range(1500):
+            yield
+        if cobs:
+            frames = bytes(received).split(b"\x00")
+            assert frames[-1] == b""
+            packets = [list(cobs_decode(f)) for f in frames[:-1]]
+        else:
+            packets = []
+            pos = 0
+            while pos < len(received):
+                count = received[pos + 1]
+                packets.append(received[pos:pos + 3 + 5 * count])
+                pos += 3 + 5 * count
+        # the FIFO delivers a hit per cycle, so packets are filled up
+        n = 0
+        for packet in packets:
+            count = packet[1]
+            assert 1 <= count <= 4
+            assert packet == expect(hits[n:n + count])
+            n += count
+        assert n == len(hits)
+        assert (yield dut.n_transmitted) == len(hits)
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(sim_uart(dut, received, busy=5))
+    with sim.write_vcd('hitser_packet.vcd', 'hitser_packet_orig.gtkw',
+                       traces=dut.ports):
+        sim.run()
+
+def sim_delta():
+    from serial_encoder import sim_uart
+
+    dut = HitSerialiser(bits=32, framing=FRAME_DELTA, n_channels=4,
+                        sync_interval=8)
+
+    sim = Simulator(dut)
+
+    hits = [(0, 0x1000, 5), (1, 0x1010, 300), (0, 0x1020, 7),
+            (0, 0x1fff, 0xffff), (2, 0xfff0, 1), (2, 0x0010, 2),
+            (1, 0x1011, 0), (3, 0x8000, 127), (3, 0x8080, 128),
+            (0, 0x2000, 9), (1, 0x2000, 9), (2, 0x2000, 9)]
+    received = []
+
+    def decode(data):
+        def varint():
+            value = 0
+            shift = 0
+            while True:
+                b = data.pop(0)
+                value |= (b & 0x7f) << shift
+                shift += 7
+                if b & 0x80 == 0:
+                    return value
+        prev = {}
+        hits = []
+        n_sync = 0
+        while data:
+            b = data.pop(0)
+            idx = b & 0x7f
+            if b & 0x80:
+                time = data.pop(0) | (data.pop(0) << 8)
+                n_sync += 1
+            else:
+                time = (prev[idx] + varint()) & 0xffff
+            prev[idx] = time
+            hits.append((idx, time, varint()))
+        return hits, n_sync
+
+    def proc():
+        yield from sim_fifo(dut, [(idx, (time << 16) | width)
+                                  for idx, time, width in hits])
+        for i in range(1000):
+            yield
+        n_bytes = len(received)
+        decoded, n_sync = decode(received)
+        assert decoded == hits
+        # four first hits and four after sync_interval
+        assert n_sync == 4 + 4
+        assert n_bytes < 6 * len(hits)
+        assert (yield dut.n_transmitted) == len(hits)
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(sim_uart(dut, received, busy=5))
+    with sim.write_vcd('hitser_delta.vcd', 'hitser_delta_orig.gtkw',
+                       traces=dut.ports):
+        sim.run()
+
+def sim_words(divisor=8):
+    dut = HitSerialiser(word_bytes=4)
+    m = Module()
+    m.submodules.dut = dut
+    m.submodules.tx = tx = UARTWideTx(word_bytes=4)
+    m.d.comb += [
+        tx.divisor.eq(divisor),
+        tx.data.eq(dut.word),
+        tx.n.eq(dut.word_n),
+        tx.valid.eq(dut.word_valid),
+        dut.word_rdy.eq(tx.ready)
+    ]
+
+    sim = Simulator(m)
+    hits = [(i, 0x01020304 * (i + 1) & 0xffffffff) for i in range(6)]
+    received = []
+    starts = []
+
+    def uart():
+        yield Passive()
+        t = 0
+        while True:
+            yield
+            t += 1
+            if (yield tx.tx_pin) == 0:
+                starts.append(t)
+                c = 0
+                for _ in range(divisor // 2):
+                    yield
+                    t += 1
+                for i in range(9):
+                    for _ in range(divisor):
+                        yield
+                        t += 1
+                    if i < 8:
+                        c |= (yield tx.tx_pin) << i
+                    else:
+                        assert (yield tx.tx_pin) == 1, "stop bit"
+                received.append(c)
+                # back to the start of the stop bit + 1 cycle
+                for _ in range(divisor // 2 - 1):
+                    yield
+                    t += 1
+
+    def fifo():
+        yield from sim_fifo(dut, hits)
+
+    def proc():
+        for _ in range(10 * divisor * 6 * (len(hits) + 1)):
+            yield
+        expected = b"".join(bytes([idx]) + value.to_bytes(4, "little")
+                            + b"\xff" for idx, value in hits)
+        assert bytes(received) == expected, bytes(received)
+        # no idle bit periods between bytes
+        assert all(b - a == 10 * divisor
+                   for a, b in zip(starts, starts[1:])), starts
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(fifo)
+    sim.add_sync_process(uart)
+    sim.run()
+
 if __name__ == '__main__':
     dut = HitSerialiser(bits=48, n_bytes=8)
 
@@ -149,3 +700,8 @@ if __name__ == '__main__':
     sim.add_sync_process(proc)
     with sim.write_vcd('hitser.vcd', 'hitser_orig.gtkw', traces=dut.ports):
         sim.run()
+
+    sim_packet()
+    sim_delta()
+    sim_packet(cobs=True)
+    sim_words()
@@ -1,18 +1,70 @@
 import os
+import re
 import json
+import bisect
 import textwrap
-from amaranth import Signal
+from amaranth import Signal, Elaboratable, Module, Mux
+from amaranth.sim import Simulator, Passive
+
+# Register kinds, see RegisterBank
+REG_RW = "rw"           # written by the host, read back
+REG_RO = "ro"           # driven by the design, read by the host
+REG_WO = "wo"           # written by the host, reads 0
+REG_STROBE = "strobe"   # the written value shows for one cycle, reads 0
 
 
 class RegisterFile():
     def __init__(self, name):
         self.name = name
         self.tables = []
+        self._index = None
+        self._index_key = None
 
     def add_table(self, table):
         self.tables.append(table)
 
+    def registers(self):
+        for t in self.tables:
+            yield from t.registers()
+
+    # Address index, built on first use and again after a table changed:
+    # the lists and ranges of all tables sorted by start address, as
+    # (start, end, name, regs) with regs keyed by address. Overlapping
+    # address ranges abort.
+    def index(self):
+        key = [(id(t), t.version) for t in self.tables]
+        if key == self._index_key:
+            return self._index
+        groups = []
+        for t in self.tables:
+            groups += t.groups()
+        groups.sort(key=lambda g: g[0])
+        for a, b in zip(groups, groups[1:]):
+            if b[0] <= a[1]:
+                print(("Address range 0x{:04x}-0x{:04x} of {} overlaps "
+                       "0x{:04x}-0x{:04x} of {}.").format(
+                           b[0], b[1], b[2], a[0], a[1], a[2]))
+                os.abort()
+        self._index = (groups, [g[0] for g in groups])
+        self._index_key = key
+        return self._index
+
+    # register at addr or None, O(log n) in the number of lists and ranges
+    def lookup(self, addr):
+        groups, starts = self.index()
+        i = bisect.bisect_right(starts, addr) - 1
+        if i < 0 or addr > groups[i][1]:
+            return None
+        return groups[i][3].get(addr)
+
+    def bank(self, addr_bits=16, data_bits=32, fanin=4):
+        groups, _ = self.index()
+        registers = [reg for g in groups for _, reg in sorted(g[3].items())]
+        return RegisterBank(registers, addr_bits=addr_bits,
+                            data_bits=data_bits, fanin=fanin)
+
     def to_json(self, filename):
+        self.index()
         registers = {}
         for t in self.tables:
             if t.shortname is not None:
@@ -24,6 +76,67 @@ class RegisterFile():
         with open(filename, "w") as f:
             json.dump(registers, f)
 
+    # host side client module with an accessor for every register, based on
+    # UartClient (uart_client.py), so reads can be batched
+    def to_python(self, filename, classname=None):
+        if classname is None:
+            classname = "".join(p.capitalize()
+                                for p in re.split(r"\W+|_", self.name)) \
+                + "Client"
+        groups, _ = self.index()
+        registers = [reg for g in groups for _, reg in sorted(g[3].items())]
+
+        text = "# Generated by RegisterFile.to_python() from register file "
+        text += "'{}', do not edit.\n\n".format(self.name)
+        text += "from uart_client import UartClient\n\n"
+        text += "# signame: (addr, bits, kind)\n"
+        text += "REGISTERS = {\n"
+        for reg in registers:
+            text += "    \"{}\": (0x{:04x}, {}, \"{}\"),\n".format(
+                reg.signame, reg.addr, reg.bits, reg.kind)
+        text += "}\n\n\n"
+        text += textwrap.dedent('''\
+            class {}(UartClient):
+
+                def check(self, name, value):
+                    bits = REGISTERS[name][1]
+                    if not 0 <= value < (1 << bits):
+                        raise ValueError("{{}} does not fit into {{}} ({{}} bits)"
+                                         .format(value, name, bits))
+
+                def read_registers(self, names):
+                    values = self.read_many([REGISTERS[n][0] for n in names])
+                    return {{n: values[REGISTERS[n][0]] for n in names}}
+
+                def read_all(self):
+                    return self.read_registers([n for n, r in REGISTERS.items()
+                                                if r[2] in ("rw", "ro")])
+
+                def write_registers(self, values):
+                    for name, value in values.items():
+                        self.check(name, value)
+                        self.queue_write(REGISTERS[name][0], value)
+                    self.flush()
+            ''').format(classname)
+        for reg in registers:
+            ident = re.sub(r"\W", "_", reg.signame)
+            if reg.kind in (REG_RW, REG_RO):
+                text += "\n    def read_{}(self) -> int:\n".format(ident)
+                text += "        return self.read(0x{:04x})[0]\n".format(
+                    reg.addr)
+            if reg.kind in (REG_RW, REG_WO, REG_STROBE):
+                text += ("\n    def write_{}(self, value: int, queue=False)"
+                         " -> None:\n").format(ident)
+                text += "        self.check(\"{}\", value)\n".format(
+                    reg.signame)
+                text += "        self.queue_write(0x{:04x}, value)\n".format(
+                    reg.addr)
+                text += "        if not queue:\n"
+                text += "            self.flush()\n"
+
+        with open(filename, "w") as f:
+            f.write(text)
+
     def to_text_long(self, filename):
         text = ""
         for t in self.tables:
@@ -42,16 +155,19 @@ class RegisterFile():
 
 
 class RegConf(dict):
-    def __init__(self, addr, bits, name, signame, reset=0, description=None):
+    def __init__(self, addr, bits, name, signame, reset=0, description=None,
+                 kind=REG_RW):
         self.addr = addr
         self.reset = reset
         self.bits = bits
         self.name = name
         self.signame = signame
         self.description = description
+        self.kind = kind
         self.signal = Signal(bits, name=signame, reset=self.reset)
         dict.__init__(self, addr=addr, reset=reset, bits=bits,
-                      signame=signame, name=name, description=description)
+                      signame=signame, name=name, description=description,
+                      kind=kind)
 
 
 class RegisterTable():
@@ -60,10 +176,13 @@ class RegisterTable():
         self.shortname = shortname
         self.dict = {}
         self.description = {}
+        # counts the changes, see RegisterFile.index()
+        self.version = 0
 
     def add_range(self, name, offset, length, description=None, bits=None):
         self.dict[name] = register_range(name, offset, length, bits)
         self.description[name] = description
+        self.version += 1
 
     def add_list(self, name, offset, description=None, names=None):
         if name in self.dict:
@@ -80,10 +199,38 @@ class RegisterTable():
         else:
             self.dict[name] = register_list(name, offset, names)
             self.description[name] = description
+        self.version += 1
 
     def new_list_array(self, name, description=None):
         self.dict[name] = []
         self.description[name] = description
+        self.version += 1
+
+    # lists and ranges as (start, end, name, regs), regs keyed by address.
+    # a range covers all addresses from its start to its end register.
+    def groups(self):
+        groups = []
+        for name, it in self.dict.items():
+            items = it if type(it) is list else [it]
+            for i, regs in enumerate(items):
+                if not regs:
+                    continue
+                if type(it) is list:
+                    name_i = "{}.{}[{}]".format(self.name, name, i)
+                else:
+                    name_i = "{}.{}".format(self.name, name)
+                addrs = [reg.addr for reg in regs.values()]
+                groups.append((min(addrs), max(addrs), name_i,
+                               {reg.addr: reg for reg in regs.values()}))
+        return groups
+
+    def registers(self):
+        for it in self.dict.values():
+            if type(it) is list:
+                for regs in it:
+                    yield from regs.values()
+            else:
+                yield from it.values()
 
     def reg_to_text(self, r):
         maximum = (1 << r.bits)
@@ -165,12 +312,16 @@ def register_list(listname, offset, names):
             description = None
         elif len(conf) == 4:
             name, bits, reset, description = conf
+        elif len(conf) == 5:
+            name, bits, reset, description, kind = conf
         else:
-            print("ERROR: register item must be a 2, 3 or 4 tuple.")
+            print("ERROR: register item must be a 2, 3, 4 or 5 tuple.")
             os.abort()
+        if len(conf) < 5:
+            kind = REG_RW
         signame = listname + "_" + name
         regs[name] = RegConf(offset + i, bits, name, signame, reset,
-                             description)
+                             description, kind)
     return regs
 
 def register_range(name, offset, length, bits):
@@ -183,3 +334,212 @@ def register_range(name, offset, length, bits):
     regs["end"] = RegConf(offset+length, bits, "end", signame+"_end", reset,
                          description)
     return regs
+
+
+# Register bank for the registers of a RegisterFile (RegisterFile.bank()),
+# with the read/write interface of UartIO. The RegConf signals are the
+# registers: REG_RW, REG_WO and REG_STROBE signals are driven by the bank,
+# REG_RO signals by the design.
+#
+# Reads go through a tree of registered OR stages, fanin values each. The
+# first stage compares r_addr with the addresses of fanin registers and
+# ORs the matching value, every further stage ORs fanin results of the
+# stage before. r_data is valid read_latency cycles after r_addr (pass it
+# to UartIO), addresses without a readable register read 0.
+
+class RegisterBank(Elaboratable):
+    def __init__(self, registers, addr_bits=16, data_bits=32, fanin=4):
+        assert(fanin >= 2), "fanin must be at least 2"
+        self.registers = registers
+        self.addr_bits = addr_bits
+        self.data_bits = data_bits
+        self.fanin = fanin
+
+        for reg in registers:
+            assert(reg.bits <= data_bits), \
+                "{} does not fit into data_bits".format(reg.signame)
+            assert(reg.addr < (1 << addr_bits)), \
+                "{} does not fit into addr_bits".format(reg.signame)
+
+        self.readable = [reg for reg in registers
+                         if reg.kind in (REG_RW, REG_RO)]
+        self.writable = [reg for reg in registers
+                         if reg.kind in (REG_RW, REG_WO, REG_STROBE)]
+
+        n = max(len(self.readable), 1)
+        self.read_latency = 1
+        while n > fanin:
+            n = (n + fanin - 1) // fanin
+            self.read_latency += 1
+
+        self.we = Signal()
+        self.w_addr = Signal(addr_bits)
+        self.w_data = Signal(data_bits)
+        self.re = Signal()
+        self.r_addr = Signal(addr_bits)
+        self.r_data = Signal(data_bits)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # write decode
+        for reg in self.writable:
+            if reg.kind == REG_STROBE:
+                m.d.sync += reg.signal.eq(0)
+        with m.If(self.we == 1):
+            with m.Switch(self.w_addr):
+                for reg in self.writable:
+                    with m.Case(reg.addr):
+                        m.d.sync += reg.signal.eq(self.w_data[:reg.bits])
+
+        # read mux tree
+        level = []
+        for i in range(0, len(self.readable), self.fanin):
+            value = Signal(self.data_bits, name="rd0_{}".format(len(level)))
+            hits = [Mux(self.r_addr == reg.addr, reg.signal, 0)
+                    for reg in self.readable[i:i + self.fanin]]
+            m.d.sync += value.eq(or_all(hits))
+            level.append(value)
+        stage = 1
+        while len(level) > 1:
+            next_level = []
+            for i in range(0, len(level), self.fanin):
+                value = Signal(self.data_bits,
+                               name="rd{}_{}".format(stage, len(next_level)))
+                m.d.sync += value.eq(or_all(level[i:i + self.fanin]))
+                next_level.append(value)
+            level = next_level
+            stage += 1
+
+        if level:
+            m.d.comb += self.r_data.eq(level[0])
+        else:
+            # no readable register, keep the latency
+            value = Signal(self.data_bits, name="rd0_0")
+            m.d.comb += self.r_data.eq(value)
+
+        return m
+
+
+def or_all(values):
+    result = values[0]
+    for v in values[1:]:
+        result = result | v
+    return result
+
+
+if __name__ == '__main__':
+    regs = RegisterFile("test")
+    t = RegisterTable("test", "t")
+    t.add_list("ctrl", 0x10, names=[
+        ("enable", 1, 1),
+        ("threshold", 16, 100),
+        ("mask", 32, 0, None, REG_WO),
+        ("reset", 1, 0, None, REG_STROBE),
+        ("status", 8, 0, None, REG_RO),
+    ])
+    t.add_list("cnt", 0x100, names=[
+        ("c{}".format(i), 32, 1000 + i) for i in range(40)])
+    regs.add_table(t)
+    ctrl = t.dict["ctrl"]
+
+    t.add_range("window", 0x200, 0x80, bits=16)
+    assert regs.lookup(0x12) is ctrl["mask"]
+    assert regs.lookup(0x127) is t.dict["cnt"]["c39"]
+    assert regs.lookup(0x280) is t.dict["window"]["end"]
+    assert regs.lookup(0x240) is None
+    assert regs.lookup(0x15) is None
+    assert regs.lookup(0) is None
+
+    dut = regs.bank(fanin=4)
+    assert dut.read_latency == 3
+    strobes = []
+
+    def read(addr):
+        yield dut.r_addr.eq(addr)
+        yield dut.re.eq(1)
+        yield
+        yield dut.re.eq(0)
+        for _ in range(dut.read_latency):
+            yield
+        return (yield dut.r_data)
+
+    def write(addr, value):
+        yield dut.w_addr.eq(addr)
+        yield dut.w_data.eq(value)
+        yield dut.we.eq(1)
+        yield
+        yield dut.we.eq(0)
+        yield
+
+    def proc():
+        yield ctrl["status"].signal.eq(0x5a)
+        assert (yield from read(0x10)) == 1
+        assert (yield from read(0x11)) == 100
+        assert (yield from read(0x14)) == 0x5a
+        for i in range(40):
+            assert (yield from read(0x100 + i)) == 1000 + i
+        assert (yield from read(0x20)) == 0
+        yield from write(0x11, 0x12345)
+        assert (yield from read(0x11)) == 0x2345
+        yield from write(0x12, 0xdeadbeef)
+        assert (yield ctrl["mask"].signal) == 0xdeadbeef
+        assert (yield from read(0x12)) == 0
+        yield from write(0x13, 1)
+        yield
+        assert (yield ctrl["reset"].signal) == 0
+        assert strobes == [1]
+        # reads are pipelined, one address per cycle
+        for i in range(8):
+            yield dut.r_addr.eq(0x100 + i)
+            yield
+            if i >= dut.read_latency:
+                assert (yield dut.r_data) == 1000 + i - dut.read_latency
+
+    def strobe():
+        yield Passive()
+        while True:
+            yield
+            if (yield ctrl["reset"].signal):
+                strobes.append((yield ctrl["reset"].signal))
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-8)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(strobe)
+    sim.run()
+
+    # generated host client against a Python model of the UART protocol
+    import sys
+    import tempfile
+    import importlib
+    from uart_client import FakePort
+
+    with tempfile.TemporaryDirectory() as d:
+        regs.to_python(os.path.join(d, "test_client.py"))
+        sys.path.insert(0, d)
+        client_module = importlib.import_module("test_client")
+        sys.path.pop(0)
+
+    port = FakePort({reg.addr: reg.reset for reg in regs.registers()})
+    client = client_module.TestClient(port)
+    values = client.read_all()
+    assert values["ctrl_threshold"] == 100
+    assert values["cnt_c39"] == 1039
+    assert "ctrl_mask" not in values
+    # 0x10-0x11, 0x14, 0x100-0x127, 0x200 and 0x280
+    assert port.n_commands == 5
+    client.write_ctrl_threshold(7, queue=True)
+    client.write_ctrl_reset(1, queue=True)
+    assert port.n_commands == 5
+    assert client.read_ctrl_threshold() == 7
+    assert port.n_commands == 8
+    try:
+        client.write_ctrl_enable(2)
+        assert False
+    except ValueError:
+        pass
+
+    # the index follows changes of an added table
+    t.add_list("extra", 0x300, names=[("spare", 8)])
+    assert regs.lookup(0x300) is t.dict["extra"]["spare"]
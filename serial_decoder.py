@@ -15,12 +15,34 @@ from amaranth.sim import *
 # R: 1 # read
 # W: 2 # write
 # I: 3 # increment
+# M: 4 # select output mode of the SerialEncoder
+# B: 5 # block read
+# P: 6 # select protocol, 0: ASCII, 1: binary (see BinaryDecoder)
 
 # Special chars
 #  : 0x0A = 10 line feed
 #  : 0x0D = 13 carriage return
 #  : 0x32 = 20 space character
 
+COMMANDS = {
+    "READ": {"char": 'R', "value": 1},
+    "WRITE": {"char": 'W', "value": 2},
+    "INSERT": {"char": 'I', "value": 3},
+    "MODE": {"char": 'M', "value": 4},
+    "BLOCK": {"char": 'B', "value": 5},
+    "PROTOCOL": {"char": 'P', "value": 6}
+}
+
+# sets 'command' to the value of the command whose char is 'char', 0 for an
+# unknown char
+def decode_command(m, char, commands, command):
+    with m.Switch(char):
+        for k, v in commands.items():
+            with m.Case(ord(v["char"])):
+                m.d.sync += command.eq(v["value"])
+        with m.Default():
+            m.d.sync += command.eq(0)
+
 class SerialDecoder(Elaboratable):
 
     def __init__(self, bufsize=16, arg_bits=32, n_args=2):
@@ -55,11 +77,7 @@ class SerialDecoder(Elaboratable):
             self.arg_off[i].name = "arg{}_off".format(i)
             self.arg_len[i].name = "arg{}_len".format(i)
 
-        self.commands = {
-            "READ": {"char": 'R', "value": 1},
-            "WRITE": {"char": 'W', "value": 2},
-            "INSERT": {"char": 'I', "value": 3}
-        }
+        self.commands = dict(COMMANDS)
         self.separator = ' '
 
         self.ports = (
@@ -213,13 +231,8 @@ class SerialDecoder(Elaboratable):
                     m.next = "DECODE_COMMAND"
 
             with m.State("DECODE_COMMAND"):
-                with m.Switch(self.buffer[0]):
-                    for k,v in self.commands.items():
-                        with m.Case(ord(v["char"])):
-                            print("{}:{}".format(k, v))
-                            m.d.sync += self.decoded_command.eq(v["value"])
-                    with m.Default():
-                        m.d.sync += self.decoded_command.eq(0)
+                decode_command(m, self.buffer[0], self.commands,
+                               self.decoded_command)
                 m.next = "WAIT_INPUT"
 
 
@@ -235,8 +248,269 @@ class SerialDecoder(Elaboratable):
         return m
 
 
-if __name__ == '__main__':
-    dut = SerialDecoder(bufsize=16)
+# streaming variant of the decoder above with the same ports. it does not
+# buffer the line, the command is taken from the first character and args
+# are accumulated as their digits arrive, so 'ready' is set the cycle after
+# the '\n' and args are not limited in length. other characters, like the
+# rest of a command word or '\r', are ignored.
+
+class SerialStreamDecoder(Elaboratable):
+
+    def __init__(self, arg_bits=32, n_args=2):
+        self.arg_bits = arg_bits
+        self.n_args = n_args
+        self.command = Signal(unsigned(4))
+        self.arg = Array([Signal(unsigned(arg_bits), name="arg{}".format(i))
+                          for i in range(n_args)])
+        self.char = Signal(8)
+        self.write = Signal()
+        self.clear = Signal()
+        self.ready = Signal()
+
+        self.commands = dict(COMMANDS)
+        self.separator = ' '
+
+        self.ports = (
+            self.char,
+            self.write,
+            self.clear,
+            self.command,
+            self.arg[0],
+            self.arg[1],
+            self.ready
+        )
+
+    def elaborate(self, platform):
+        m = Module()
+
+        write_prev = Signal()
+        write_rose = Signal()
+        is_digit = Signal()
+        digit = Signal(4)
+        seen_separator = Signal()
+        arg_n = Signal(range(self.n_args))
+        decoded_command = Signal.like(self.command)
+        decoded_arg = Array([
+            Signal(unsigned(self.arg_bits), name="dec_arg{}".format(i))
+            for i in range(self.n_args)])
+
+        m.d.sync += write_prev.eq(self.write)
+        m.d.comb += [
+            write_rose.eq((self.write == 1) & (write_prev == 0)),
+            is_digit.eq((self.char >= ord('0')) & (self.char <= ord('9'))),
+            digit.eq(self.char - ord('0'))
+        ]
+
+        with m.FSM(reset="COMMAND"):
+            # first character of a line
+            with m.State("COMMAND"):
+                with m.If(write_rose == 1):
+                    m.d.sync += [
+                        self.ready.eq(0),
+                        seen_separator.eq(0),
+                        arg_n.eq(0)
+                    ] + [decoded_arg[i].eq(0) for i in range(self.n_args)]
+                    decode_command(m, self.char, self.commands,
+                                   decoded_command)
+                    with m.If(self.char == 0x0a):
+                        m.d.sync += [
+                            self.command.eq(0),
+                            self.ready.eq(1)
+                        ] + [self.arg[i].eq(0) for i in range(self.n_args)]
+                    with m.Else():
+                        m.next = "LINE"
+
+            with m.State("LINE"):
+                with m.If(write_rose == 1):
+                    with m.If(self.char == 0x0a):
+                        m.d.sync += [
+                            self.command.eq(decoded_command),
+                            self.ready.eq(1)
+                        ] + [self.arg[i].eq(decoded_arg[i])
+                             for i in range(self.n_args)]
+                        m.next = "COMMAND"
+                    with m.Elif(self.char == ord(self.separator)):
+                        m.d.sync += seen_separator.eq(1)
+                        with m.If((seen_separator == 1)
+                                  & (arg_n < self.n_args - 1)):
+                            m.d.sync += arg_n.eq(arg_n + 1)
+                    with m.Elif((is_digit == 1) & (seen_separator == 1)):
+                        m.d.sync += decoded_arg[arg_n].eq(
+                            decoded_arg[arg_n] * 10 + digit)
+
+        with m.If(self.clear == 1):
+            m.d.sync += [
+                self.command.eq(0),
+                self.arg[0].eq(0),
+                self.arg[1].eq(0)
+            ]
+
+        return m
+
+
+# binary variant of the ASCII decoders above, with the same outputs.
+# a command is an opcode byte (the command value) followed by its args in
+# fixed width little endian fields, no separators and no terminator:
+#
+# R: 0x01 addr count      read count registers starting at addr
+# W: 0x02 addr data       write data to register at addr
+# M: 0x04 mode            select output mode of the SerialEncoder
+# B: 0x05 addr count      block read
+# P: 0x06 protocol        select protocol, 0: ASCII, 1: binary
+#
+# addr has addr_bytes, data has data_bytes, count has 2 and mode and
+# protocol have 1 byte. bytes that are not a known opcode are ignored while
+# waiting for an opcode. 'ready' is pulsed once the last arg byte arrived.
+
+class BinaryDecoder(Elaboratable):
+
+    def __init__(self, arg_bits=32, n_args=2, addr_bytes=2, data_bytes=4):
+        assert(max(addr_bytes, data_bytes, 2) * 8 <= arg_bits), \
+            "args do not fit into arg_bits"
+        self.arg_bits = arg_bits
+        self.n_args = n_args
+        self.addr_bytes = addr_bytes
+        self.data_bytes = data_bytes
+        self.command = Signal(unsigned(4))
+        self.arg = Array([Signal(unsigned(arg_bits), name="arg{}".format(i))
+                          for i in range(n_args)])
+        self.char = Signal(8)
+        self.write = Signal()
+        self.clear = Signal()
+        self.ready = Signal()
+
+        # number of bytes of the args of each command
+        self.commands = {
+            "READ": {"value": 1, "args": (addr_bytes, 2)},
+            "WRITE": {"value": 2, "args": (addr_bytes, data_bytes)},
+            "MODE": {"value": 4, "args": (1, 0)},
+            "BLOCK": {"value": 5, "args": (addr_bytes, 2)},
+            "PROTOCOL": {"value": 6, "args": (1, 0)}
+        }
+
+        self.ports = (
+            self.char,
+            self.write,
+            self.clear,
+            self.command,
+            self.arg[0],
+            self.arg[1],
+            self.ready
+        )
+
+    def elaborate(self, platform):
+        m = Module()
+
+        max_bytes = max(sum(v["args"]) for v in self.commands.values())
+        write_prev = Signal()
+        write_rose = Signal()
+        pos = Signal(range(max_bytes + 1))
+        len0 = Signal(range(max_bytes + 1))
+        n_bytes = Signal(range(max_bytes + 1))
+
+        pos1 = Signal.like(pos)
+
+        m.d.sync += write_prev.eq(self.write)
+        m.d.comb += [
+            write_rose.eq((self.write == 1) & (write_prev == 0)),
+            pos1.eq(pos - len0)
+        ]
+
+        with m.FSM(reset="OPCODE") as fsm:
+
+            m.d.comb += self.ready.eq(fsm.ongoing("READY"))
+
+            with m.State("OPCODE"):
+                with m.If(write_rose == 1):
+                    with m.Switch(self.char):
+                        for k, v in self.commands.items():
+                            with m.Case(v["value"]):
+                                m.d.sync += [
+                                    self.command.eq(v["value"]),
+                                    self.arg[0].eq(0),
+                                    self.arg[1].eq(0),
+                                    pos.eq(0),
+                                    len0.eq(v["args"][0]),
+                                    n_bytes.eq(sum(v["args"]))
+                                ]
+                                if sum(v["args"]) > 0:
+                                    m.next = "ARGS"
+                                else:
+                                    m.next = "READY"
+
+            with m.State("ARGS"):
+                with m.If(self.clear == 1):
+                    m.next = "OPCODE"
+                with m.Elif(write_rose == 1):
+                    with m.If(pos < len0):
+                        m.d.sync += self.arg[0].word_select(
+                            pos, 8).eq(self.char)
+                    with m.Else():
+                        m.d.sync += self.arg[1].word_select(
+                            pos1, 8).eq(self.char)
+                    m.d.sync += pos.eq(pos + 1)
+                    with m.If(pos == n_bytes - 1):
+                        m.next = "READY"
+
+            with m.State("READY"):
+                m.next = "OPCODE"
+
+        with m.If(self.clear == 1):
+            m.d.sync += [
+                self.command.eq(0),
+                self.arg[0].eq(0),
+                self.arg[1].eq(0)
+            ]
+
+        return m
+
+def sim_binary():
+    dut = BinaryDecoder()
+    sim = Simulator(dut)
+
+    def write(data):
+        for c in data:
+            yield dut.char.eq(c)
+            yield dut.write.eq(1)
+            yield
+            yield dut.write.eq(0)
+            yield
+
+    def test_command(name, arg0, arg1=0):
+        cmd = dut.commands[name]
+        data = bytes([cmd["value"]])
+        data += arg0.to_bytes(cmd["args"][0], "little")
+        data += arg1.to_bytes(cmd["args"][1], "little")
+        yield from write(data[:-1])
+        yield dut.char.eq(data[-1])
+        yield dut.write.eq(1)
+        yield
+        yield dut.write.eq(0)
+        yield
+        assert (yield dut.ready) == 1
+        yield
+        assert (yield dut.ready) == 0
+        assert (yield dut.command) == cmd["value"]
+        assert (yield dut.arg[0]) == arg0
+        assert (yield dut.arg[1]) == arg1
+
+    def proc():
+        # unknown bytes are skipped
+        yield from write(b"R 5\r\n")
+        yield from test_command("READ", 0x1234, 10)
+        yield from test_command("WRITE", 0xfffe, 0xdeadbeef)
+        yield from test_command("WRITE", 7, 0)
+        yield from test_command("BLOCK", 0, 1024)
+        yield from test_command("MODE", 2)
+        yield from test_command("PROTOCOL", 0)
+
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    with sim.write_vcd('binary_dec.vcd', 'binary_dec_orig.gtkw',
+                       traces=dut.ports):
+        sim.run()
+
+def sim_ascii(dut, vcd):
     sim = Simulator(dut)
 
     def write_char(char, speed_divider=1):
@@ -348,5 +622,11 @@ if __name__ == '__main__':
 
     sim.add_clock(1e-6)
     sim.add_sync_process(proc)
-    with sim.write_vcd('serial_dec.vcd', 'serial_dec_orig.gtkw', traces=dut.ports):
+    with sim.write_vcd(vcd, vcd.replace('.vcd', '_orig.gtkw'),
+                       traces=dut.ports):
         sim.run()
+
+if __name__ == '__main__':
+    sim_ascii(SerialDecoder(bufsize=16), 'serial_dec.vcd')
+    sim_ascii(SerialStreamDecoder(), 'serial_stream_dec.vcd')
+    sim_binary()
@@ -1,7 +1,7 @@
 from amaranth import *
 from amaranth.sim import *
 
-from bcd import BinToBcd
+from bcd import BinToBcd, BinToBcdPipelined
 
 import math
 
@@ -9,12 +9,26 @@ import math
 # it is connected to a UART TX and will send the transformed sequence on
 # the wire. every sequence of integers is terminated by '\r\n'.
 # to use the encoder, fill the buffer with bytes, and raise the trg signal.
+# with bcd_stages > 0 the pipelined BinToBcd is used, which converts a value
+# in bcd_stages cycles instead of 2 * 32.
+#
+# the output format is selected with 'mode' when trg is raised:
+# MODE_DEC: decimal without leading zeros, followed by a space
+# MODE_HEX: 8 hex digits, followed by a space
+# MODE_BIN: 4 bytes, little endian, no spacer
+# the sequence is terminated by '\r\n' in all modes.
+
+MODE_DEC = 0
+MODE_HEX = 1
+MODE_BIN = 2
 
 class SerialEncoder(Elaboratable):
-    def __init__(self, bufsize=16):
+    def __init__(self, bufsize=16, bcd_stages=0):
         self.bufsize = bufsize
+        self.bcd_stages = bcd_stages
 
         self.data = Signal(unsigned(32))
+        self.mode = Signal(2)
         self.write = Signal()
         self.trg = Signal()
         self.rdy = Signal()
@@ -25,6 +39,7 @@ class SerialEncoder(Elaboratable):
         self.ports = [
             self.write,
             self.data,
+            self.mode,
             self.trg,
             self.rdy,
             self.tx,
@@ -32,8 +47,151 @@ class SerialEncoder(Elaboratable):
             self.tx_trg
         ]
 
+    def make_bcd(self):
+        if self.bcd_stages > 0:
+            return BinToBcdPipelined(bits=32, stages=self.bcd_stages)
+        return BinToBcd(bits=32)
+
+    def value_states(self, m, bcd, word, mode, done):
+        # states sending 'word' in the format 'mode', starting in "LOAD" and
+        # continuing in state 'done' afterwards.
+
+        bcd_pos = Signal(unsigned(5))
+        seen_nonzero = Signal()
+        nibble = Signal(4)
+
+        with m.State("LOAD"):
+            m.d.sync += [
+                bcd_pos.eq(0),
+                seen_nonzero.eq(0)
+            ]
+            with m.Switch(mode):
+                with m.Case(MODE_HEX):
+                    m.next = "SEND_HEX"
+                with m.Case(MODE_BIN):
+                    m.next = "SEND_BIN"
+                with m.Default():
+                    m.d.sync += [
+                        bcd.bin.eq(word),
+                        bcd.trg.eq(1)
+                    ]
+                    m.next = "BCD_TRG_OFF"
+
+        with m.State("BCD_TRG_OFF"):
+            m.d.sync += bcd.trg.eq(0)
+            m.next = "CONVERT_BCD"
+
+        with m.State("CONVERT_BCD"):
+            with m.If(bcd.rdy == 1):
+                m.next = "SEND_BCD"
+
+        with m.State("SEND_BCD"):
+            with m.If(bcd_pos < 11):
+                digit = bcd.bcd.word_select((10 - bcd_pos).as_unsigned(), 4)
+                m.d.sync += bcd_pos.eq(bcd_pos + 1)
+                with m.If((bcd_pos == (bcd.digits - 1)) |
+                    (digit != 0) | (seen_nonzero == 1)):
+                    m.d.sync += [
+                        seen_nonzero.eq(1),
+                        self.tx.eq(digit + ord('0')),
+                        self.tx_trg.eq(1),
+                    ]
+                    m.next = "WAIT_TX"
+                with m.Else():
+                    m.next = "SEND_BCD"
+            with m.Else():
+                m.next = "SEND_SPACER"
+
+        with m.State("SEND_HEX"):
+            with m.If(bcd_pos < 8):
+                m.d.comb += nibble.eq(
+                    word.word_select((7 - bcd_pos).as_unsigned(), 4))
+                m.d.sync += [
+                    bcd_pos.eq(bcd_pos + 1),
+                    self.tx.eq(Mux(nibble < 10, nibble + ord('0'),
+                                   nibble + (ord('a') - 10))),
+                    self.tx_trg.eq(1)
+                ]
+                m.next = "WAIT_TX"
+            with m.Else():
+                m.next = "SEND_SPACER"
+
+        with m.State("SEND_BIN"):
+            with m.If(bcd_pos < 4):
+                m.d.sync += [
+                    bcd_pos.eq(bcd_pos + 1),
+                    self.tx.eq(word.word_select(bcd_pos[:2], 8)),
+                    self.tx_trg.eq(1)
+                ]
+                m.next = "WAIT_TX"
+            with m.Else():
+                m.next = done
+
+        with m.State("WAIT_TX"):
+            m.d.sync += self.tx_trg.eq(0)
+            m.next = "WAIT_TX2"
+
+        with m.State("WAIT_TX2"):
+            with m.If(self.tx_rdy == 1):
+                with m.Switch(mode):
+                    with m.Case(MODE_HEX):
+                        m.next = "SEND_HEX"
+                    with m.Case(MODE_BIN):
+                        m.next = "SEND_BIN"
+                    with m.Default():
+                        m.next = "SEND_BCD"
+
+        with m.State("SEND_SPACER"):
+            m.d.sync += [
+                self.tx.eq(ord(' ')),
+                self.tx_trg.eq(1)
+            ]
+            m.next = "SEND_SPACER2"
+
+        with m.State("SEND_SPACER2"):
+            m.d.sync += self.tx_trg.eq(0)
+            m.next = "SEND_SPACER3"
+
+        with m.State("SEND_SPACER3"):
+            with m.If(self.tx_rdy == 1):
+                m.next = done
+
+    def terminator_states(self, m, done):
+        # states sending '\r\n', starting in "SEND_TERMINATOR1" and
+        # continuing in state 'done' afterwards.
+
+        with m.State("SEND_TERMINATOR1"):
+            m.d.sync += [
+                self.tx.eq(ord('\r')),
+                self.tx_trg.eq(1)
+            ]
+            m.next = "SEND_TERMINATOR2"
+
+        with m.State("SEND_TERMINATOR2"):
+            m.d.sync += self.tx_trg.eq(0)
+            m.next = "SEND_TERMINATOR3"
+
+        with m.State("SEND_TERMINATOR3"):
+            with m.If(self.tx_rdy == 1):
+                m.next = "SEND_TERMINATOR4"
+
+        with m.State("SEND_TERMINATOR4"):
+            m.d.sync += [
+                self.tx.eq(ord('\n')),
+                self.tx_trg.eq(1)
+            ]
+            m.next = "SEND_TERMINATOR5"
+
+        with m.State("SEND_TERMINATOR5"):
+            m.d.sync += self.tx_trg.eq(0)
+            m.next = "SEND_TERMINATOR6"
+
+        with m.State("SEND_TERMINATOR6"):
+            with m.If(self.tx_rdy == 1):
+                m.next = done
+
     def elaborate(self, platform):
-        bcd = BinToBcd(bits=32)
+        bcd = self.make_bcd()
         buffer = Array([Signal(unsigned(32)) for _ in range(self.bufsize)])
         size = Signal(unsigned(8))
 
@@ -43,8 +201,8 @@ class SerialEncoder(Elaboratable):
 
         bytes_to_encode = Signal(unsigned(8))
         pos = Signal(8)
-        bcd_pos = Signal(unsigned(5))
-        seen_nonzero = Signal()
+        mode = Signal.like(self.mode)
+        word = Signal(unsigned(32))
 
         with m.FSM(reset="IDLE"):
 
@@ -53,7 +211,8 @@ class SerialEncoder(Elaboratable):
                 with m.If(self.trg == 1):
                     m.d.sync += [
                         bytes_to_encode.eq(size),
-                        pos.eq(0)
+                        pos.eq(0),
+                        mode.eq(self.mode)
                     ]
                     m.next = "ENCODE"
                 with m.If(self.write == 1):
@@ -65,113 +224,186 @@ class SerialEncoder(Elaboratable):
 
             with m.State("ENCODE"):
                 with m.If(bytes_to_encode > 0):
+                    m.d.sync += word.eq(buffer[pos])
                     m.next = "LOAD"
                 with m.Else():
                     m.next = "SEND_TERMINATOR1"
 
-            with m.State("LOAD"):
+            self.value_states(m, bcd, word, mode, "ADVANCE")
+
+            with m.State("ADVANCE"):
+                with m.If(bytes_to_encode > 0):
+                    m.d.sync += [
+                        bytes_to_encode.eq(bytes_to_encode - 1),
+                        pos.eq(pos + 1)
+                    ]
+                m.next = "ENCODE"
+
+            self.terminator_states(m, "DONE")
+
+            with m.State("DONE"):
                 m.d.sync += [
-                    bcd.bin.eq(buffer[pos]),
-                    bcd.trg.eq(1),
-                    bcd_pos.eq(0),
-                    seen_nonzero.eq(0)
+                    self.rdy.eq(1),
+                    size.eq(0)
                 ]
-                m.next = "BCD_TRG_OFF"
+                m.next = "IDLE"
 
-            with m.State("BCD_TRG_OFF"):
-                m.d.sync += bcd.trg.eq(0)
-                m.next = "CONVERT_BCD"
+        return m
 
-            with m.State("CONVERT_BCD"):
-                with m.If(bcd.rdy == 1):
-                    m.next = "SEND_BCD"
+# streaming variant of the encoder above, without a buffer.
+# values are taken from 'data' whenever 'valid' and 'ready' are high and are
+# sent right away. '\r\n' is only sent after a value with 'last' set, so a
+# record can have any number of values. 'mode' is sampled with every value.
 
-            with m.State("SEND_BCD"):
-                with m.If(bcd_pos < 11):
-                    digit = bcd.bcd.word_select((10 - bcd_pos).as_unsigned(), 4)
-                    m.d.sync += bcd_pos.eq(bcd_pos + 1)
-                    with m.If((bcd_pos == (bcd.digits - 1)) |
-                        (digit != 0) | (seen_nonzero == 1)):
-                        m.d.sync += [
-                            seen_nonzero.eq(1),
-                            self.tx.eq(digit + ord('0')),
-                            self.tx_trg.eq(1),
-                        ]
-                        m.next = "WAIT_TX"
-                    with m.Else():
-                        m.next = "SEND_BCD"
-                with m.Else():
-                    m.next = "SEND_SPACER"
+class SerialStreamEncoder(SerialEncoder):
+    def __init__(self, bcd_stages=0):
+        self.bcd_stages = bcd_stages
 
-            with m.State("WAIT_TX"):
-                m.d.sync += self.tx_trg.eq(0)
-                m.next = "WAIT_TX2"
+        self.data = Signal(unsigned(32))
+        self.mode = Signal(2)
+        self.valid = Signal()
+        self.last = Signal()
+        self.ready = Signal()
+        self.tx = Signal(unsigned(8))
+        self.tx_rdy = Signal()
+        self.tx_trg = Signal()
 
-            with m.State("WAIT_TX2"):
-                with m.If(self.tx_rdy == 1):
-                    m.next = "SEND_BCD"
+        self.ports = [
+            self.data,
+            self.mode,
+            self.valid,
+            self.last,
+            self.ready,
+            self.tx,
+            self.tx_rdy,
+            self.tx_trg
+        ]
 
-            with m.State("SEND_SPACER"):
-                m.d.sync += [
-                    self.tx.eq(ord(' ')),
-                    self.tx_trg.eq(1)
-                ]
-                m.next = "SEND_SPACER2"
+    def elaborate(self, platform):
+        bcd = self.make_bcd()
 
-            with m.State("SEND_SPACER2"):
-                m.d.sync += self.tx_trg.eq(0)
-                m.next = "SEND_SPACER3"
+        m = Module()
 
-            with m.State("SEND_SPACER3"):
-                with m.If(self.tx_rdy == 1):
-                    m.next = "ADVANCE"
+        m.submodules.bcd = bcd
 
-            with m.State("ADVANCE"):
-                with m.If(bytes_to_encode > 0):
+        mode = Signal.like(self.mode)
+        word = Signal(unsigned(32))
+        last = Signal()
+
+        with m.FSM(reset="IDLE") as fsm:
+
+            m.d.comb += self.ready.eq(fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                with m.If(self.valid == 1):
                     m.d.sync += [
-                        bytes_to_encode.eq(bytes_to_encode - 1),
-                        pos.eq(pos + 1)
+                        word.eq(self.data),
+                        last.eq(self.last),
+                        mode.eq(self.mode)
                     ]
-                m.next = "ENCODE"
+                    m.next = "LOAD"
 
-            with m.State("SEND_TERMINATOR1"):
-                m.d.sync += [
-                    self.tx.eq(ord('\r')),
-                    self.tx_trg.eq(1)
-                ]
-                m.next = "SEND_TERMINATOR2"
+            self.value_states(m, bcd, word, mode, "NEXT")
 
-            with m.State("SEND_TERMINATOR2"):
-                m.d.sync += self.tx_trg.eq(0)
-                m.next = "SEND_TERMINATOR3"
+            with m.State("NEXT"):
+                with m.If(last == 1):
+                    m.next = "SEND_TERMINATOR1"
+                with m.Else():
+                    m.next = "IDLE"
 
-            with m.State("SEND_TERMINATOR3"):
-                with m.If(self.tx_rdy == 1):
-                    m.next = "SEND_TERMINATOR4"
+            self.terminator_states(m, "IDLE")
 
-            with m.State("SEND_TERMINATOR4"):
-                m.d.sync += [
-                    self.tx.eq(ord('\n')),
-                    self.tx_trg.eq(1)
-                ]
-                m.next = "SEND_TERMINATOR5"
+        return m
 
-            with m.State("SEND_TERMINATOR5"):
-                m.d.sync += self.tx_trg.eq(0)
-                m.next = "SEND_TERMINATOR6"
+def sim_uart(dut, received, busy=3):
+    # process standing in for a UART TX in simulations: appends the byte on
+    # tx to 'received' on tx_trg, then keeps tx_rdy low for 'busy' cycles
+    def uart():
+        yield Passive()
+        yield dut.tx_rdy.eq(1)
+        while True:
+            yield
+            if (yield dut.tx_trg) == 1:
+                received.append((yield dut.tx))
+                yield dut.tx_rdy.eq(0)
+                for _ in range(busy):
+                    yield
+                yield dut.tx_rdy.eq(1)
+    return uart
 
-            with m.State("SEND_TERMINATOR6"):
-                with m.If(self.tx_rdy == 1):
-                    m.next = "DONE"
+def sim_output(bcd_stages, mode=MODE_DEC):
+    dut = SerialEncoder(bufsize=16, bcd_stages=bcd_stages)
 
-            with m.State("DONE"):
-                m.d.sync += [
-                    self.rdy.eq(1),
-                    size.eq(0)
-                ]
-                m.next = "IDLE"
+    sim = Simulator(dut)
 
-        return m
+    values = [0x4, 0x0a, 0xfe, 0x1337, 0x0, 0xffffffff]
+    received = []
+
+    def proc():
+        for value in values:
+            yield dut.data.eq(value)
+            yield dut.write.eq(1)
+            yield
+            yield dut.write.eq(0)
+            yield
+        yield dut.mode.eq(mode)
+        yield dut.trg.eq(1)
+        yield
+        yield dut.trg.eq(0)
+        yield
+        while (yield dut.rdy) == 0:
+            yield
+        if mode == MODE_HEX:
+            expected = "".join("{:08x} ".format(v) for v in values).encode()
+        elif mode == MODE_BIN:
+            expected = b"".join(v.to_bytes(4, "little") for v in values)
+        else:
+            expected = "".join("{} ".format(v) for v in values).encode()
+        assert bytes(received) == expected + b"\r\n", bytes(received)
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(sim_uart(dut, received))
+    sim.run()
+
+def sim_stream(mode=MODE_DEC):
+    dut = SerialStreamEncoder()
+
+    sim = Simulator(dut)
+
+    records = [list(range(1000, 1040)), [7], [0xdeadbeef, 0]]
+    received = []
+
+    def proc():
+        yield dut.mode.eq(mode)
+        for record in records:
+            for i, value in enumerate(record):
+                yield dut.data.eq(value)
+                yield dut.last.eq(i == len(record) - 1)
+                yield dut.valid.eq(1)
+                yield
+                while (yield dut.ready) == 0:
+                    yield
+            yield dut.valid.eq(0)
+        yield
+        while (yield dut.ready) == 0:
+            yield
+        expected = b""
+        for record in records:
+            for value in record:
+                if mode == MODE_HEX:
+                    expected += "{:08x} ".format(value).encode()
+                elif mode == MODE_BIN:
+                    expected += value.to_bytes(4, "little")
+                else:
+                    expected += "{} ".format(value).encode()
+            expected += b"\r\n"
+        assert bytes(received) == expected, bytes(received)
+
+    sim.add_clock(1/12e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(sim_uart(dut, received))
+    sim.run()
 
 if __name__ == '__main__':
     dut = SerialEncoder(bufsize=16)
@@ -235,3 +467,10 @@ if __name__ == '__main__':
     sim.add_sync_process(proc)
     with sim.write_vcd('serial_enc.vcd', 'serial_enc_orig.gtkw', traces=dut.ports):
         sim.run()
+
+    sim_output(bcd_stages=0)
+    sim_output(bcd_stages=4)
+    sim_output(bcd_stages=0, mode=MODE_HEX)
+    sim_output(bcd_stages=0, mode=MODE_BIN)
+    sim_stream(mode=MODE_DEC)
+    sim_stream(mode=MODE_BIN)
@@ -3,9 +3,15 @@
 from amaranth import *
 from amaranth.lib import wiring
 from amaranth.lib.wiring import In, Out
+from amaranth.lib.cdc import FFSynchronizer
 from amaranth.sim import *
 from edge_detect import EdgeDetector
 
+# SpiRegisterBridge commands
+SPI_READ = 0x01
+SPI_WRITE = 0x02
+SPI_HITS = 0x03
+
 class SpiDevice(wiring.Component):
 
     cs_n: In(1, init=1)
@@ -34,7 +40,7 @@ class SpiDevice(wiring.Component):
         m = Module()
         m.submodules.ed_sclk = ed_sclk
 
-        m.d.comb += ed_sclk.input.eq(sclk)
+        m.d.comb += ed_sclk.i.eq(sclk)
 
         m.d.comb += cs_n_int.eq(self.cs_n | self.busy)
 
@@ -76,6 +82,596 @@ class SpiDevice(wiring.Component):
 
         return m
 
+
+# Register bridge with the same read/write interface as UartIO.
+#
+# A transaction (cs_n low) is, all fields LSB first:
+# command: 8 bits, SPI_READ or SPI_WRITE
+# address: 8 * addr_bytes bits
+# length:  16 bits, number of words, 0 is one word
+# words:   data_bits each
+#
+# Words are read from / written to consecutive addresses starting at
+# address. For reads, the first word is fetched while the length is shifted
+# in and every following word while the previous one is shifted out, so
+# words go out back to back. Words beyond length are ignored on writes and
+# read as 0. Raising cs_n ends the transaction at any point.
+#
+# With hits=True, SPI_HITS streams hits out of a readout FIFO (fifo_r_data,
+# fifo_rdy, fifo_r_en, fifo_level, first-word-fall-through like SyncFIFO).
+# The address is ignored and length is the number of hits the host reads at
+# most. The first word sent is a header with the number of hits n that
+# follow, min(fifo_level, length), then n hits of data_bits each and 0 for
+# the rest of the transaction. Only the n hits are taken from the FIFO.
+#
+# Inputs are synchronised to the sys clock and SCLK edges are detected
+# there, SPI mode 0: sdi is sampled on the rising edge of SCLK, sdo changes
+# shortly after it. sdo switches to the next bit in the cycle the edge is
+# detected, also at word boundaries, so SCLK can go up to about a quarter of
+# the sys clock.
+
+class SpiRegisterBridge(wiring.Component):
+
+    def __init__(self, data_bits=32, addr_bytes=2, read_latency=1, hits=False):
+        self.data_bits = data_bits
+        self.addr_bytes = addr_bytes
+        self.addr_bits = 8 * addr_bytes
+        self.read_latency = read_latency
+        self.hits = hits
+        fifo = {
+            "fifo_r_data": In(data_bits),
+            "fifo_rdy": In(1),
+            "fifo_r_en": Out(1),
+            "fifo_level": In(16),
+        } if hits else {}
+        super().__init__({
+            "cs_n": In(1, init=1),
+            "sclk": In(1),
+            "sdi": In(1),
+            "sdo": Out(1),
+
+            "we": Out(1),
+            "w_addr": Out(self.addr_bits),
+            "w_data": Out(data_bits),
+            "re": Out(1),
+            "r_addr": Out(self.addr_bits),
+            "r_data": In(data_bits),
+            **fifo
+        })
+
+    def connect(self, cs_n, sclk, sdi, sdo, we, w_addr, w_data, re, r_addr,
+                r_data):
+        return [self.cs_n.eq(cs_n), self.sclk.eq(sclk), self.sdi.eq(sdi),
+                sdo.eq(self.sdo),
+                we.eq(self.we), w_addr.eq(self.w_addr), w_data.eq(self.w_data),
+                re.eq(self.re), r_addr.eq(self.r_addr), self.r_data.eq(r_data)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        cs_n = Signal(init=1)
+        sclk = Signal()
+        sdi = Signal()
+        m.submodules.sync_cs_n = FFSynchronizer(self.cs_n, cs_n, init=1)
+        m.submodules.sync_sclk = FFSynchronizer(self.sclk, sclk)
+        m.submodules.sync_sdi = FFSynchronizer(self.sdi, sdi)
+
+        m.submodules.ed_sclk = ed_sclk = EdgeDetector()
+        m.d.comb += ed_sclk.i.eq(sclk)
+
+        width = max(8, self.addr_bits, 16, self.data_bits)
+        sr_in = Signal(width)
+        sr_out = Signal(self.data_bits)
+        n_bits = Signal(range(width + 1))
+        shift = Signal()
+        command = Signal(8)
+        addr = Signal(self.addr_bits)
+        read_addr = Signal(self.addr_bits)
+        n_words = Signal(16)
+        n_fetch = Signal(16)
+        n_hits = Signal(16)
+        length = Signal(16)
+        next_word = Signal(self.data_bits)
+        load = Signal()
+        re_delay = Signal(self.read_latency)
+        # the bit sr_out[0] takes with this shift, put on sdo right away
+        next_bit = Signal()
+
+        m.d.comb += [
+            shift.eq((cs_n == 0) & ed_sclk.rose),
+            next_bit.eq(sr_out[1]),
+            self.sdo.eq(Mux(shift, next_bit, sr_out[0]))
+        ]
+
+        with m.If(shift):
+            m.d.sync += [
+                sr_in.eq(Cat(sr_in[1:], sdi)),
+                n_bits.eq(n_bits + 1),
+                sr_out.eq(sr_out[1:])
+            ]
+
+        # read data arrives read_latency cycles after re
+        m.d.sync += [
+            re_delay.eq(Cat(self.re, re_delay[:-1])),
+            self.re.eq(0),
+            self.we.eq(0)
+        ]
+        with m.If(re_delay[-1]):
+            m.d.sync += next_word.eq(self.r_data)
+
+        def field(bits):
+            # value of a field of 'bits' bits, once all of them are shifted
+            # in, including the one shifted in this cycle
+            return Cat(sr_in[width - bits + 1:], sdi)
+
+        m.d.comb += length.eq(Mux(field(16) == 0, 1, field(16)))
+
+        def fetch(addr):
+            return [
+                self.re.eq(1),
+                self.r_addr.eq(addr),
+                read_addr.eq(addr + 1)
+            ]
+
+        def end_on_cs_n():
+            with m.If(cs_n == 1):
+                m.next = "COMMAND"
+
+        with m.FSM(init="COMMAND"):
+            with m.State("COMMAND"):
+                with m.If(shift & (n_bits == 7)):
+                    m.d.sync += [
+                        command.eq(field(8)),
+                        n_bits.eq(0)
+                    ]
+                    m.next = "ADDRESS"
+                end_on_cs_n()
+
+            with m.State("ADDRESS"):
+                with m.If(shift & (n_bits == self.addr_bits - 1)):
+                    m.d.sync += [
+                        addr.eq(field(self.addr_bits)),
+                        n_bits.eq(0)
+                    ]
+                    # fetch the first word while the length is shifted in
+                    with m.If(command == SPI_READ):
+                        m.d.sync += fetch(field(self.addr_bits))
+                    m.next = "LENGTH"
+                end_on_cs_n()
+
+            with m.State("LENGTH"):
+                with m.If(shift & (n_bits == 15)):
+                    m.d.sync += [
+                        n_words.eq(length),
+                        n_fetch.eq(Mux(field(16) == 0, 0, field(16) - 1)),
+                        n_bits.eq(0),
+                        load.eq(1)
+                    ]
+                    with m.If(command == SPI_READ):
+                        # the first word goes out right after the length
+                        m.d.comb += next_bit.eq(next_word[0])
+                        m.d.sync += [
+                            sr_out.eq(next_word),
+                            next_word.eq(0)
+                        ]
+                        m.next = "READ"
+                    with m.Elif(command == SPI_WRITE):
+                        m.next = "WRITE"
+                    if self.hits:
+                        with m.Elif(command == SPI_HITS):
+                            n_avail = Mux(self.fifo_level < length,
+                                          self.fifo_level, length)
+                            m.d.comb += next_bit.eq(n_avail[0])
+                            m.d.sync += [
+                                sr_out.eq(n_avail),
+                                n_hits.eq(n_avail)
+                            ]
+                            m.next = "HITS"
+                    with m.Else():
+                        m.next = "IGNORE"
+                end_on_cs_n()
+
+            with m.State("READ"):
+                # a word is loaded with the last bit of the previous one, the
+                # one after it is fetched in the next cycle
+                with m.If(load):
+                    m.d.sync += load.eq(0)
+                    with m.If(n_fetch > 0):
+                        m.d.sync += [
+                            n_fetch.eq(n_fetch - 1),
+                            fetch(read_addr)
+                        ]
+                with m.If(shift & (n_bits == self.data_bits - 1)):
+                    m.d.comb += next_bit.eq(next_word[0])
+                    m.d.sync += [
+                        n_bits.eq(0),
+                        sr_out.eq(next_word),
+                        next_word.eq(0),
+                        load.eq(1)
+                    ]
+                end_on_cs_n()
+
+            with m.State("WRITE"):
+                with m.If(shift & (n_bits == self.data_bits - 1)):
+                    m.d.sync += n_bits.eq(0)
+                    with m.If(n_words > 0):
+                        m.d.sync += [
+                            self.we.eq(1),
+                            self.w_addr.eq(addr),
+                            self.w_data.eq(field(self.data_bits)),
+                            addr.eq(addr + 1),
+                            n_words.eq(n_words - 1)
+                        ]
+                end_on_cs_n()
+
+            if self.hits:
+                with m.State("HITS"):
+                    # the header is loaded on entry, every hit with the last
+                    # bit of the word before it
+                    with m.If(shift & (n_bits == self.data_bits - 1)):
+                        m.d.comb += next_bit.eq(0)
+                        m.d.sync += [
+                            n_bits.eq(0),
+                            sr_out.eq(0)
+                        ]
+                        with m.If((n_hits > 0) & self.fifo_rdy):
+                            m.d.comb += [
+                                self.fifo_r_en.eq(1),
+                                next_bit.eq(self.fifo_r_data[0])
+                            ]
+                            m.d.sync += [
+                                sr_out.eq(self.fifo_r_data),
+                                n_hits.eq(n_hits - 1)
+                            ]
+                    end_on_cs_n()
+
+            with m.State("IGNORE"):
+                end_on_cs_n()
+
+        with m.If(cs_n == 1):
+            m.d.sync += [
+                n_bits.eq(0),
+                sr_out.eq(0),
+                load.eq(0)
+            ]
+
+        return m
+# Variant of SpiDevice with the shift registers clocked by SCLK itself, so
+# SCLK can go up to about half the sys clock. Full duplex and streaming: while
+# cs_n is low, words of 32 bits (LSB first, SPI mode 0) are shifted in on
+# the rising and out on the falling edges of SCLK, back to back.
+#
+# RX: every received word is handed to the sys domain with a toggle that
+# is synchronised by FFSynchronizer, 'ready' pulses with the word in r_data.
+# The word register is only written every 32 SCLK cycles, so it is stable
+# when the toggle arrives.
+# TX: two sys domain buffers are sent alternately, starting with the first
+# one written after the last transaction. w_en writes w_data to the next
+# free buffer while w_rdy is high. A buffer is free again once the SCLK
+# side moved on to the other one (again a synchronised toggle), so the next
+# word has to be written within one word time to keep the stream going.
+# 'busy' is the synchronised cs_n.
+
+class SpiSclkDevice(wiring.Component):
+
+    cs_n: In(1, init=1)
+    sclk: In(1)
+    sdi: In(1)
+    sdo: Out(1)
+
+    r_data: Out(32)
+    busy: Out(1)
+    ready: Out(1)
+    w_en: In(1)
+    w_data: In(32)
+    w_rdy: Out(1)
+
+    def elaborate(self, platform):
+        n_bits = 32
+        m = Module()
+
+        # SCLK domains, bit counters are reset while cs_n is high
+        m.domains.spi = cd_spi = ClockDomain("spi", async_reset=True,
+                                             local=True)
+        m.domains.spi_hold = cd_spi_hold = ClockDomain("spi_hold",
+                                                       reset_less=True,
+                                                       local=True)
+        m.domains.spi_neg = cd_spi_neg = ClockDomain("spi_neg",
+                                                     clk_edge="neg",
+                                                     async_reset=True,
+                                                     local=True)
+        m.domains.spi_neg_hold = cd_spi_neg_hold = ClockDomain(
+                "spi_neg_hold", clk_edge="neg", reset_less=True, local=True)
+        m.d.comb += [
+            cd_spi.clk.eq(self.sclk),
+            cd_spi.rst.eq(self.cs_n),
+            cd_spi_hold.clk.eq(self.sclk),
+            cd_spi_neg.clk.eq(self.sclk),
+            cd_spi_neg.rst.eq(self.cs_n),
+            cd_spi_neg_hold.clk.eq(self.sclk),
+        ]
+
+        # receive
+        rx_cnt = Signal(range(n_bits))
+        rx_sr = Signal(n_bits)
+        rx_word = Signal(n_bits)
+        rx_tgl = Signal()
+        rx_tgl_sys = Signal()
+        rx_tgl_prev = Signal()
+
+        m.d.spi += [
+            rx_sr.eq(Cat(rx_sr[1:], self.sdi)),
+            rx_cnt.eq(rx_cnt + 1)
+        ]
+        with m.If(rx_cnt == n_bits - 1):
+            m.d.spi_hold += [
+                rx_word.eq(Cat(rx_sr[1:], self.sdi)),
+                rx_tgl.eq(~rx_tgl)
+            ]
+
+        m.submodules.sync_rx = FFSynchronizer(rx_tgl, rx_tgl_sys)
+        m.d.sync += [
+            rx_tgl_prev.eq(rx_tgl_sys),
+            self.ready.eq(rx_tgl_sys != rx_tgl_prev)
+        ]
+        with m.If(rx_tgl_sys != rx_tgl_prev):
+            m.d.sync += self.r_data.eq(rx_word)
+
+        # transmit
+        tx_buf = Array([Signal(n_bits, name="tx_buf{}".format(i))
+                        for i in range(2)])
+        tx_cnt = Signal(range(n_bits))
+        tx_sel = Signal()
+        tx_tgl = Signal()
+        tx_tgl_sys = Signal()
+        tx_tgl_prev = Signal()
+        w_sel = Signal()
+        n_free = Signal(range(3), init=2)
+        cs_n = Signal(init=1)
+        cs_n_prev = Signal(init=1)
+
+        m.d.spi_neg += tx_cnt.eq(tx_cnt + 1)
+        with m.If(tx_cnt == n_bits - 1):
+            m.d.spi_neg += tx_sel.eq(~tx_sel)
+            m.d.spi_neg_hold += tx_tgl.eq(~tx_tgl)
+        m.d.comb += self.sdo.eq(tx_buf[tx_sel].bit_select(tx_cnt, 1))
+
+        m.submodules.sync_tx = FFSynchronizer(tx_tgl, tx_tgl_sys)
+        m.submodules.sync_cs_n = FFSynchronizer(self.cs_n, cs_n, init=1)
+        m.d.sync += [
+            tx_tgl_prev.eq(tx_tgl_sys),
+            cs_n_prev.eq(cs_n)
+        ]
+        m.d.comb += [
+            self.busy.eq(~cs_n),
+            self.w_rdy.eq(n_free > 0)
+        ]
+
+        write = Signal()
+        freed = Signal()
+        m.d.comb += [
+            write.eq(self.w_en & (n_free > 0)),
+            freed.eq(tx_tgl_sys != tx_tgl_prev)
+        ]
+        with m.If(write):
+            m.d.sync += [
+                tx_buf[w_sel].eq(self.w_data),
+                w_sel.eq(~w_sel)
+            ]
+        with m.If(cs_n & ~cs_n_prev):
+            # the next transaction starts with buffer 0 again
+            m.d.sync += [
+                n_free.eq(2),
+                w_sel.eq(0)
+            ]
+        with m.Elif(write & ~freed):
+            m.d.sync += n_free.eq(n_free - 1)
+        with m.Elif(~write & freed & (n_free < 2)):
+            m.d.sync += n_free.eq(n_free + 1)
+
+        return m
+
+
+
+def sim_bridge(half_period=3, read_latency=1):
+    from uart_io import RegisterModel
+
+    dut = SpiRegisterBridge(read_latency=read_latency)
+    top = RegisterModel(dut)
+
+    def transfer(bits_out, n_in):
+        # shifts bits_out out (LSB first per field) and n_in bits in
+        bits_in = []
+        for i in range(max(len(bits_out), n_in)):
+            yield dut.sdi.eq(bits_out[i] if i < len(bits_out) else 0)
+            for _ in range(half_period):
+                yield
+            yield dut.sclk.eq(1)
+            bits_in.append((yield dut.sdo))
+            for _ in range(half_period):
+                yield
+            yield dut.sclk.eq(0)
+        return bits_in
+
+    def bits(value, n):
+        return [(value >> i) & 1 for i in range(n)]
+
+    def transaction(command, addr, length, words=(), n_read=0):
+        yield dut.cs_n.eq(0)
+        for _ in range(4):
+            yield
+        out = bits(command, 8) + bits(addr, 16) + bits(length, 16)
+        for w in words:
+            out += bits(w, 32)
+        bits_in = yield from transfer(out, 40 + 32 * n_read)
+        for _ in range(half_period):
+            yield
+        yield dut.cs_n.eq(1)
+        for _ in range(8):
+            yield
+        bits_in = bits_in[40:]
+        return [sum(b << i for i, b in enumerate(bits_in[32 * k:32 * k + 32]))
+                for k in range(n_read)]
+
+    def proc():
+        for _ in range(4):
+            yield
+        words = yield from transaction(SPI_READ, 3, 1, n_read=1)
+        assert words == [1021], words
+        words = yield from transaction(SPI_READ, 10, 20, n_read=21)
+        assert words == [1000 + 7 * i for i in range(10, 30)] + [0], words
+        yield from transaction(SPI_WRITE, 5, 3,
+                               [0xdeadbeef, 0x12345678, 0xffffffff, 99])
+        words = yield from transaction(SPI_READ, 4, 0, n_read=1)
+        assert words == [1028], words
+        words = yield from transaction(SPI_READ, 4, 5, n_read=5)
+        assert words == [1028, 0xdeadbeef, 0x12345678, 0xffffffff, 1056], \
+            [hex(w) for w in words]
+        # aborted transfer
+        yield dut.cs_n.eq(0)
+        yield from transfer(bits(SPI_WRITE, 8) + bits(1, 5), 0)
+        yield dut.cs_n.eq(1)
+        for _ in range(8):
+            yield
+        words = yield from transaction(SPI_READ, 0, 2, n_read=2)
+        assert words == [1000, 1007], words
+
+    sim = Simulator(top)
+    sim.add_clock(1/100e6)
+    sim.add_sync_process(proc)
+    with sim.write_vcd('spi_bridge.vcd', 'spi_bridge_orig.gtkw',
+                       traces=[dut.cs_n, dut.sclk, dut.sdi, dut.sdo, dut.re,
+                               dut.we]):
+        sim.run()
+
+def sim_hits(half_period=3):
+    from amaranth.lib.fifo import SyncFIFO
+
+    dut = SpiRegisterBridge(hits=True)
+    fifo = SyncFIFO(width=32, depth=16)
+    m = Module()
+    m.submodules.dut = dut
+    m.submodules.fifo = fifo
+    m.d.comb += [
+        dut.fifo_r_data.eq(fifo.r_data),
+        dut.fifo_rdy.eq(fifo.r_rdy),
+        fifo.r_en.eq(dut.fifo_r_en),
+        dut.fifo_level.eq(fifo.level)
+    ]
+
+    def transaction(length, n_read):
+        yield dut.cs_n.eq(0)
+        out = [(SPI_HITS >> i) & 1 for i in range(8)] + [0] * 16 \
+            + [(length >> i) & 1 for i in range(16)]
+        bits_in = []
+        for i in range(40 + 32 * n_read):
+            yield dut.sdi.eq(out[i] if i < len(out) else 0)
+            for _ in range(half_period):
+                yield
+            yield dut.sclk.eq(1)
+            bits_in.append((yield dut.sdo))
+            for _ in range(half_period):
+                yield
+            yield dut.sclk.eq(0)
+        yield dut.cs_n.eq(1)
+        for _ in range(8):
+            yield
+        bits_in = bits_in[40:]
+        return [sum(b << i for i, b in enumerate(bits_in[32 * k:32 * k + 32]))
+                for k in range(n_read)]
+
+    hits = [0x1000 + i for i in range(8)]
+
+    def proc():
+        for hit in hits:
+            yield fifo.w_data.eq(hit)
+            yield fifo.w_en.eq(1)
+            yield
+        yield fifo.w_en.eq(0)
+        for _ in range(4):
+            yield
+        words = yield from transaction(5, 6)
+        assert words == [5] + hits[:5], words
+        words = yield from transaction(10, 6)
+        assert words == [3] + hits[5:] + [0, 0], words
+        assert (yield fifo.level) == 0
+        words = yield from transaction(10, 2)
+        assert words == [0, 0], words
+
+    sim = Simulator(m)
+    sim.add_clock(1/100e6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+def sim_sclk():
+    # SCLK at half the sys clock
+    dut = SpiSclkDevice()
+    received = []
+
+    def transaction(words_out, words_in):
+        n = max(len(words_out), words_in)
+        yield dut.cs_n.eq(0)
+        yield
+        bits_in = []
+        for k in range(n):
+            for i in range(32):
+                # word k + 1 goes to the buffer freed at the start of word k
+                if i == 8 and k + 1 < len(words_out):
+                    assert (yield dut.w_rdy) == 1
+                    yield dut.w_data.eq(words_out[k + 1])
+                    yield dut.w_en.eq(1)
+                if i == 9:
+                    yield dut.w_en.eq(0)
+                yield dut.sdi.eq((words_out[k] >> i) & 1
+                                 if k < len(words_out) else 0)
+                yield dut.sclk.eq(0)
+                yield
+                bits_in.append((yield dut.sdo))
+                yield dut.sclk.eq(1)
+                yield
+        yield dut.sclk.eq(0)
+        yield
+        yield dut.cs_n.eq(1)
+        for _ in range(8):
+            yield
+        return [sum(b << i for i, b in enumerate(bits_in[32 * k:32 * k + 32]))
+                for k in range(words_in)]
+
+    def collect():
+        yield Passive()
+        while True:
+            yield
+            if (yield dut.ready):
+                received.append((yield dut.r_data))
+
+    def proc():
+        for _ in range(4):
+            yield
+        words = [0x12345678, 0xdeadbeef, 0x0, 0xffffffff, 0x80000001, 7]
+        # first word before the transaction, the rest while it runs
+        yield dut.w_data.eq(words[0])
+        yield dut.w_en.eq(1)
+        yield
+        yield dut.w_en.eq(0)
+        yield
+        echoed = yield from transaction(words, len(words))
+        assert echoed == words, [hex(w) for w in echoed]
+        assert received == words, [hex(w) for w in received]
+        assert (yield dut.busy) == 0
+        yield dut.w_data.eq(0xcafe)
+        yield dut.w_en.eq(1)
+        yield
+        yield dut.w_en.eq(0)
+        yield
+        echoed = yield from transaction([0xcafe, 0xbabe], 2)
+        assert echoed == [0xcafe, 0xbabe], [hex(w) for w in echoed]
+
+    sim = Simulator(dut)
+    sim.add_clock(1/100e6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(collect)
+    sim.run()
+
 if __name__=="__main__":
     dut = SpiDevice()
 
@@ -147,3 +743,12 @@ if __name__=="__main__":
     sim.add_sync_process(proc)
     with sim.write_vcd('tb_spi.vcd', 'tb_spi_orig.gtkw'):
         sim.run()
+
+    sim_bridge()
+    sim_bridge(read_latency=3)
+    # SCLK at a quarter of the sys clock
+    sim_bridge(half_period=2)
+    sim_bridge(half_period=2, read_latency=3)
+    sim_hits()
+    sim_hits(half_period=2)
+    sim_sclk()
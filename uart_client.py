@@ -0,0 +1,387 @@
+import asyncio
+import collections
+import os
+
+# Host side client for the ASCII protocol of UartIO (see uart_io.py).
+#
+# 'port' is anything with write(bytes) and readline() -> bytes, e.g. a
+# serial.Serial. Responses are expected in the default decimal output mode.
+#
+# Reads of several addresses are coalesced: runs of consecutive addresses
+# (allowing gaps of up to max_gap unused addresses) become one 'B addr
+# count' block read each. Up to queue_depth commands are sent before the
+# first response is read, so they fit into the command queue of UartIO and
+# a batch costs about one round trip.
+#
+# Writes can be queued with queue_write() and are sent in one go by flush(),
+# which also happens before every read, so reads see all earlier writes.
+
+class UartClient():
+    def __init__(self, port, queue_depth=4, max_gap=0):
+        self.port = port
+        self.queue_depth = queue_depth
+        self.max_gap = max_gap
+        self.pending_writes = []
+
+    def send(self, text):
+        self.port.write(text.encode())
+
+    def receive_line(self):
+        line = self.port.readline()
+        if not line.endswith(b"\r\n"):
+            raise IOError("incomplete response {!r}".format(line))
+        return [int(v) for v in line.split()]
+
+    def write(self, addr, value):
+        self.queue_write(addr, value)
+        self.flush()
+
+    def queue_write(self, addr, value):
+        self.pending_writes.append("W {} {}\r\n".format(addr, value))
+
+    def flush(self):
+        if self.pending_writes:
+            self.send("".join(self.pending_writes))
+            self.pending_writes = []
+
+    def read(self, addr, count=1):
+        return self.read_blocks([(addr, count)])[0]
+
+    def read_blocks(self, blocks):
+        # blocks: list of (addr, count), returns a list of value lists
+        self.flush()
+        results = []
+        n_sent = 0
+        for addr, count in blocks:
+            self.send("B {} {}\r\n".format(addr, count))
+            n_sent += 1
+            if n_sent - len(results) >= self.queue_depth:
+                results.append(self.receive_line())
+        while len(results) < n_sent:
+            results.append(self.receive_line())
+        for (addr, count), values in zip(blocks, results):
+            if len(values) != count:
+                raise IOError("expected {} values from 0x{:04x}, got {}".format(
+                    count, addr, len(values)))
+        return results
+
+    def coalesce(self, addrs):
+        blocks = []
+        for addr in sorted(set(addrs)):
+            if blocks and addr <= blocks[-1][0] + blocks[-1][1] + self.max_gap:
+                blocks[-1][1] = addr - blocks[-1][0] + 1
+            else:
+                blocks.append([addr, 1])
+        return [tuple(b) for b in blocks]
+
+    def read_many(self, addrs):
+        # returns {addr: value} for all addrs
+        blocks = self.coalesce(addrs)
+        values = {}
+        for (addr, count), result in zip(blocks, self.read_blocks(blocks)):
+            for i, v in enumerate(result):
+                values[addr + i] = v
+        return {addr: values[addr] for addr in addrs}
+
+
+class FakePort():
+    # Python model of UartIO and a register file for tests without hardware
+    def __init__(self, regs=None):
+        self.regs = dict(regs or {})
+        self.output = bytearray()
+        self.input = bytearray()
+        self.n_commands = 0
+
+    def write(self, data):
+        self.input += data
+        while b"\n" in self.input:
+            line, _, rest = bytes(self.input).partition(b"\n")
+            self.input = bytearray(rest)
+            self.execute(line.decode().split())
+
+    def execute(self, words):
+        self.n_commands += 1
+        args = [int(w) for w in words[1:]] + [0, 0]
+        count = max(args[1], 1)
+        values = [self.regs.get(args[0] + i, 0) for i in range(count)]
+        if words[0] == "R":
+            for v in values:
+                self.output += "{} \r\n".format(v).encode()
+        elif words[0] == "B":
+            self.output += "".join("{} ".format(v) for v in values).encode()
+            self.output += b"\r\n"
+        elif words[0] == "W":
+            self.regs[args[0]] = args[1]
+
+    def readline(self):
+        line, sep, rest = bytes(self.output).partition(b"\n")
+        self.output = bytearray(rest)
+        return line + sep
+
+
+# asyncio version of UartClient for polling several boards from one process.
+# 'reader' and 'writer' are asyncio streams, open_serial() makes them for a
+# serial port or pty. Commands are sent as they come, with at most
+# queue_depth waiting to be executed, so they fit into the command queue of
+# UartIO, and the responses are matched to the commands in order by a reader
+# task.
+#
+# A write has no response, so write() follows it with a read of the same
+# address and returns once that arrives. The write and the read both count
+# against queue_depth. Response lines that match no command are dropped and
+# counted in 'errors'. After close() or a lost port, all waiting commands
+# fail with an IOError.
+
+class AsyncUartClient():
+    def __init__(self, reader, writer, queue_depth=4, read_transport=None):
+        assert(queue_depth >= 2), "queue_depth must be at least 2"
+        self.reader = reader
+        self.writer = writer
+        # closed with the client, see open_serial()
+        self.read_transport = read_transport
+        self.slots = asyncio.Semaphore(queue_depth)
+        # taking several slots at once must not interleave with other tasks
+        self.sending = asyncio.Lock()
+        self.waiting = collections.deque()
+        self.errors = 0
+        self.closed = None
+        self.task = asyncio.get_running_loop().create_task(self.receive())
+
+    def fail_waiting(self, reason):
+        self.closed = reason
+        while self.waiting:
+            future, n_slots = self.waiting.popleft()
+            # wakes up commands waiting for a slot, they fail as well
+            for _ in range(n_slots):
+                self.slots.release()
+            if not future.done():
+                future.set_exception(IOError(reason))
+
+    async def receive(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if not self.waiting:
+                    self.errors += 1
+                    continue
+                future, n_slots = self.waiting.popleft()
+                for _ in range(n_slots):
+                    self.slots.release()
+                if future.done():
+                    # the caller was cancelled
+                    continue
+                try:
+                    if not line.endswith(b"\r\n"):
+                        raise ValueError("incomplete")
+                    future.set_result([int(v) for v in line.split()])
+                except ValueError:
+                    future.set_exception(
+                        IOError("bad response {!r}".format(line)))
+        except OSError as e:
+            self.fail_waiting("port failed: {}".format(e))
+        else:
+            self.fail_waiting("port closed")
+
+    async def command(self, text, n_slots=1):
+        # text holds n_slots commands, the last one has the only response
+        async with self.sending:
+            taken = 0
+            try:
+                for _ in range(n_slots):
+                    await self.slots.acquire()
+                    taken += 1
+            except asyncio.CancelledError:
+                for _ in range(taken):
+                    self.slots.release()
+                raise
+        if self.closed is not None:
+            for _ in range(n_slots):
+                self.slots.release()
+            raise IOError(self.closed)
+        future = asyncio.get_running_loop().create_future()
+        # no await between queueing and sending keeps them in order
+        self.waiting.append((future, n_slots))
+        self.writer.write(text.encode())
+        return await future
+
+    async def read(self, addr, count=1):
+        values = await self.command("B {} {}\r\n".format(addr, count))
+        if len(values) != count:
+            raise IOError("expected {} values from 0x{:04x}, got {}".format(
+                count, addr, len(values)))
+        return values
+
+    async def write(self, addr, value):
+        await self.command("W {} {}\r\nB {} 1\r\n".format(addr, value, addr),
+                           n_slots=2)
+
+    async def close(self):
+        self.task.cancel()
+        if self.read_transport is not None:
+            self.read_transport.close()
+        self.writer.close()
+        self.fail_waiting("client closed")
+
+async def open_serial(path, baudrate=None):
+    import termios, tty
+    loop = asyncio.get_running_loop()
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    if baudrate is not None:
+        attrs = termios.tcgetattr(fd)
+        speed = getattr(termios, "B{}".format(baudrate))
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    # each transport closes its own fd
+    reader = asyncio.StreamReader()
+    read_file = os.fdopen(os.dup(fd), "rb", buffering=0)
+    write_file = os.fdopen(fd, "wb", buffering=0)
+    read_transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), read_file)
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, write_file)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer, read_transport
+
+def serve_pty(port):
+    # serves a FakePort on a pty like uart_sim.py, returns the device name
+    import pty, threading, tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+
+    def serve():
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                break
+            port.write(data)
+            if port.output:
+                os.write(master, bytes(port.output))
+                port.output = bytearray()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return os.ttyname(slave)
+
+
+if __name__ == '__main__':
+    port = FakePort({i: 1000 + 7 * i for i in range(64)})
+    client = UartClient(port, max_gap=1)
+
+    assert client.coalesce([5, 3, 4, 10, 12, 20]) == [(3, 3), (10, 3), (20, 1)]
+    assert client.read(3) == [1021]
+    assert client.read(10, 3) == [1070, 1077, 1084]
+
+    port.n_commands = 0
+    addrs = list(range(0, 40)) + [50, 52, 60]
+    values = client.read_many(addrs)
+    assert values == {a: 1000 + 7 * a for a in addrs}
+    assert port.n_commands == 3
+
+    client.queue_write(4, 77)
+    client.queue_write(5, 78)
+    assert port.regs[4] == 1028
+    assert client.read_many([4, 5]) == {4: 77, 5: 78}
+
+    async def poll_boards():
+        boards = []
+        for k in range(3):
+            fake = FakePort({i: 100 * k + i for i in range(64)})
+            reader, writer, read_transport = await open_serial(
+                serve_pty(fake))
+            boards.append(AsyncUartClient(reader, writer, queue_depth=2,
+                                          read_transport=read_transport))
+
+        # all boards at once, several reads in flight on each
+        reads = [board.read(addr, 3) for board in boards
+                 for addr in range(0, 40, 4)]
+        results = await asyncio.gather(*reads)
+        expected = [[100 * k + addr + i for i in range(3)]
+                    for k in range(3) for addr in range(0, 40, 4)]
+        assert results == expected, results
+
+        await boards[1].write(5, 1234)
+        assert await boards[1].read(4, 3) == [104, 1234, 106]
+        assert await boards[0].read(5) == [5]
+        for board in boards:
+            await board.close()
+
+    async def in_flight():
+        class Writer():
+            data = b""
+
+            def write(self, data):
+                self.data += data
+
+            def close(self):
+                pass
+
+        async def settle():
+            for _ in range(5):
+                await asyncio.sleep(0)
+
+        reader = asyncio.StreamReader()
+        writer = Writer()
+        client = AsyncUartClient(reader, writer, queue_depth=2)
+
+        # the write and its read back wait for the two reads in flight
+        tasks = [asyncio.ensure_future(c) for c in
+                 [client.read(1), client.read(2), client.write(3, 9)]]
+        await settle()
+        assert writer.data == b"B 1 1\r\nB 2 1\r\n"
+        reader.feed_data(b"11 \r\n")
+        await settle()
+        assert writer.data == b"B 1 1\r\nB 2 1\r\n"
+        reader.feed_data(b"12 \r\n")
+        await settle()
+        assert writer.data.endswith(b"W 3 9\r\nB 3 1\r\n")
+        reader.feed_data(b"9 \r\n")
+        assert await asyncio.gather(*tasks) == [[11], [12], None]
+
+        # a line without a command does not stop the reader task
+        reader.feed_data(b"5 \r\n")
+        await settle()
+        assert client.errors == 1
+        task = asyncio.ensure_future(client.read(4))
+        await settle()
+        reader.feed_data(b"14 \r\n")
+        assert await task == [14]
+
+        # a write cancelled while it waits for its second slot gives back
+        # the first one
+        task = asyncio.ensure_future(client.read(5))
+        await settle()
+        cancelled = asyncio.ensure_future(client.write(6, 1))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        reader.feed_data(b"15 \r\n")
+        assert await task == [15]
+        task = asyncio.ensure_future(client.write(7, 2))
+        await settle()
+        assert writer.data.endswith(b"W 7 2\r\nB 7 1\r\n")
+        reader.feed_data(b"2 \r\n")
+        await task
+
+        # close fails the waiting commands
+        tasks = [asyncio.ensure_future(client.read(i)) for i in range(3)]
+        await settle()
+        await client.close()
+        for task in tasks:
+            try:
+                await task
+                assert False
+            except IOError:
+                pass
+
+        # a failing port keeps its reason
+        reader = asyncio.StreamReader()
+        client = AsyncUartClient(reader, Writer())
+        reader.set_exception(OSError("unplugged"))
+        await settle()
+        assert client.closed == "port failed: unplugged", client.closed
+
+    asyncio.run(poll_boards())
+    asyncio.run(in_flight())
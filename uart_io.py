@@ -1,23 +1,70 @@
-from amaranth import (Signal, Elaboratable, unsigned, Module, Const)
-from amaranth.sim import Simulator
-from external.uart import UART
-from serial_decoder import SerialDecoder
-from serial_encoder import SerialEncoder
+from amaranth import (Signal, Elaboratable, unsigned, Module, Const, Mux,
+                      Cat, Array)
+from amaranth.sim import Simulator, Passive
+from amaranth.lib.fifo import SyncFIFO
+from external.uart import BufferedUART
+from serial_decoder import SerialStreamDecoder, BinaryDecoder
+from serial_encoder import SerialStreamEncoder
 from edge_detect import EdgeDetector
 
+# Commands (see serial_decoder.py):
+# R addr count: read count registers starting at addr, every value is sent
+#               as its own line terminated by '\r\n'
+# B addr count: block read, all count values are sent in one line
+# W addr value: write value to register at addr
+# M mode:       set output format of the SerialEncoder
+# P protocol:   0: ASCII commands, 1: binary commands
+#
+# With binary_protocol set, a BinaryDecoder runs next to the ASCII decoder
+# and 'P 1' switches the input to it, see BinaryDecoder for the frame
+# format. The binary command 0x06 0x00 switches back to ASCII. Only the
+# decoder of the selected protocol sees the received bytes. Responses are
+# the same for both protocols, use M to select their format.
+#
+# Reads are pipelined: addresses are issued back to back on r_addr with re
+# high, and r_data is expected read_latency cycles after re. The values are
+# buffered in a FIFO of read_depth values in front of the encoder, by
+# default max(8, read_latency + 3), the least the read pipeline needs.
+#
+# Decoded commands are queued in a FIFO of queue_depth entries, so a host
+# can send further commands while a response is still being sent. Responses
+# come out in order. If the queue is full, the command is dropped and
+# queue_overflow is set. A pulse on 'clear' resets it.
+#
+# The UART has FIFOs on both sides (tx_depth, rx_depth), so received bytes
+# are not lost while the decoder is busy. rx_overrun is set if the RX FIFO
+# overflowed anyway, 'clear' resets it as well. The bit period is
+# divisor + divisor_frac / 256 cycles, see external/uart.py.
+#
+# bcd_stages selects the decimal converter of the encoder, see
+# serial_encoder.py: with bcd_stages > 0 the pipelined one is used, which
+# keeps up with the UART on long register dumps.
+
 
 class UartIO(Elaboratable):
-    def __init__(self, data_bits=8, addr_bits=4, clock_frequency=0):
+    def __init__(self, data_bits=8, addr_bits=4, clock_frequency=0,
+                 read_latency=1, queue_depth=4, binary_protocol=False,
+                 tx_depth=16, rx_depth=16, read_depth=None, bcd_stages=0):
 
         # Parameters
         self.data_bits = data_bits
         self.addr_bits = addr_bits
-        self.arg_bits = data_bits
+        self.read_latency = read_latency
+        if read_depth is None:
+            read_depth = max(8, read_latency + 3)
+        self.read_depth = read_depth
+        self.queue_depth = queue_depth
+        self.binary_protocol = binary_protocol
+        self.tx_depth = tx_depth
+        self.rx_depth = rx_depth
+        # the args hold an address, a value or a 16 bit count
+        self.arg_bits = max(data_bits, addr_bits, 16)
         self.clock_frequency = clock_frequency
         self.divisor = Signal(16)
+        self.divisor_frac = Signal(8)
 
         # Hardware IO
-        self.rx_pin = Signal()
+        self.rx_pin = Signal(reset=1)
         self.tx_pin = Signal()
 
         # Module IO
@@ -27,9 +74,20 @@ class UartIO(Elaboratable):
         self.re = Signal()
         self.r_data = Signal(self.data_bits)
         self.r_addr = Signal(self.addr_bits)
-
-        self.encoder = SerialEncoder()
-        self.decoder = SerialDecoder(bufsize=10, arg_bits=self.data_bits)
+        self.queue_overflow = Signal()
+        self.rx_overrun = Signal()
+        self.protocol = Signal()
+        self.clear = Signal()
+
+        self.uart = BufferedUART(tx_depth=tx_depth, rx_depth=rx_depth)
+        self.encoder = SerialStreamEncoder(bcd_stages=bcd_stages)
+        self.decoder = SerialStreamDecoder(arg_bits=self.arg_bits)
+        self.binary_decoder = None
+        if binary_protocol:
+            self.binary_decoder = BinaryDecoder(
+                    arg_bits=self.arg_bits,
+                    addr_bytes=(self.addr_bits + 7) // 8,
+                    data_bytes=(self.data_bits + 7) // 8)
 
     def connect(self, rx_pin, tx_pin, we, w_addr, w_data, re, r_addr, r_data,
                 divisor):
@@ -42,27 +100,52 @@ class UartIO(Elaboratable):
 
         m = Module()
 
-        m.submodules.uart = uart = UART()
+        m.submodules.uart = uart = self.uart
         m.submodules.decoder = decoder = self.decoder
         m.submodules.encoder = encoder = self.encoder
-        m.submodules.uart_fsm = uart_fsm = UartFsm(decoder, encoder,
-                                                   data_bits=self.data_bits,
-                                                   addr_bits=self.addr_bits)
+        binary_decoder = self.binary_decoder
+        if binary_decoder is not None:
+            m.submodules.binary_decoder = binary_decoder
+        m.submodules.uart_fsm = uart_fsm = UartFsm(
+                decoder, encoder, data_bits=self.data_bits,
+                addr_bits=self.addr_bits, arg_bits=self.arg_bits,
+                read_latency=self.read_latency, read_depth=self.read_depth,
+                queue_depth=self.queue_depth, binary_decoder=binary_decoder)
         self.encoder = encoder
         self.decoder = decoder
 
+        # the decoders shift in a byte on a rising edge of 'write', so the RX
+        # FIFO is read at most every other cycle
+        rx_ack = Signal()
+        rx_ack_prev = Signal()
+        m.d.sync += rx_ack_prev.eq(rx_ack)
+
         # connect uart to pins and data
         m.d.comb += [
                 uart.rx_pin.eq(self.rx_pin),
                 self.tx_pin.eq(uart.tx_pin),
+                rx_ack.eq(uart.rx_rdy & ~rx_ack_prev),
+                uart.rx_ack.eq(rx_ack),
                 decoder.char.eq(uart.rx_data),
-                decoder.write.eq(uart.rx_rdy),
+                decoder.write.eq(rx_ack & ~uart_fsm.protocol),
                 uart.divisor.eq(self.divisor),
+                uart.divisor_frac.eq(self.divisor_frac),
                 uart.tx_data.eq(encoder.tx),
                 uart.tx_trg.eq(encoder.tx_trg),
                 encoder.tx_rdy.eq(uart.tx_rdy),
+                self.queue_overflow.eq(uart_fsm.queue_overflow),
+                uart_fsm.clear.eq(self.clear),
+                uart.clear.eq(self.clear),
+                self.rx_overrun.eq(uart.rx_overrun),
+                self.protocol.eq(uart_fsm.protocol),
         ]
 
+        if binary_decoder is not None:
+            m.d.comb += [
+                binary_decoder.char.eq(uart.rx_data),
+                binary_decoder.write.eq(rx_ack & uart_fsm.protocol)
+            ]
+
         # connect fsm
         m.d.comb += uart_fsm.connect(we=self.we, write_addr=self.w_addr,
                                      write_data=self.w_data,
@@ -74,16 +157,25 @@ class UartIO(Elaboratable):
 
 
 class UartFsm(Elaboratable):
-    def __init__(self, decoder, encoder, data_bits=8, addr_bits=4):
+    def __init__(self, decoder, encoder, data_bits=8, addr_bits=4,
+                 arg_bits=None, read_latency=1, read_depth=8, queue_depth=4,
+                 binary_decoder=None):
 
         # Parameters
         self.n_args = 2
         self.data_bits = data_bits
         self.addr_bits = addr_bits
+        self.arg_bits = data_bits if arg_bits is None else arg_bits
+        self.read_latency = read_latency
+        self.read_depth = read_depth
+        self.queue_depth = queue_depth
+        assert(read_depth >= read_latency + 3), \
+            "read_depth must be at least read_latency + 3"
 
         # Submodules
         self.encoder = encoder
         self.decoder = decoder
+        self.binary_decoder = binary_decoder
 
         # Inputs
         # Data from register
@@ -93,8 +185,6 @@ class UartFsm(Elaboratable):
         # Select address to read from
         self.re = Signal()
         self.read_addr = Signal(self.addr_bits)
-        # Data to send out over TX
-        self.uart_tx_data = Signal(unsigned(self.data_bits))
 
         # Writing
         self.we = Signal()
@@ -103,6 +193,14 @@ class UartFsm(Elaboratable):
         # Data to write at address
         self.write_data = Signal(self.data_bits)
 
+        # Status
+        # A command was dropped, because the command queue was full
+        self.queue_overflow = Signal()
+        # Resets queue_overflow
+        self.clear = Signal()
+        # Selected protocol, 0: ASCII (decoder), 1: binary (binary_decoder)
+        self.protocol = Signal()
+
     def connect(self, we, write_addr, write_data, read_data, read_addr, re):
         return [we.eq(self.we), write_addr.eq(self.write_addr),
                 write_data.eq(self.write_data),
@@ -117,14 +215,13 @@ class UartFsm(Elaboratable):
         # receiver side
         decode_ready = Signal()
         start = Signal()
+        select_protocol = Signal()
 
         m.submodules.decode_edge = decode_edge = EdgeDetector()
-        m.d.comb += decode_edge.connect(i=decode_ready, o=start)
+        m.d.comb += decode_edge.i.eq(decode_ready)
 
-        read_val = Signal(16)
         read_addr = self.read_addr
         re = self.re
-        uart_tx_data = self.uart_tx_data
         read_data = self.read_data
         write_addr = self.write_addr
         write_data = self.write_data
@@ -133,74 +230,125 @@ class UartFsm(Elaboratable):
         decoder = self.decoder
 
         command = Signal(unsigned(4))
-        arg = [Signal(unsigned(self.data_bits)) for _ in range(self.n_args)]
+        arg = [Signal(unsigned(self.arg_bits)) for _ in range(self.n_args)]
+        pending = Signal()
+
+        # command queue, command and args are taken from its head
+        m.submodules.cmd_fifo = cmd_fifo = SyncFIFO(
+                width=len(command) + self.n_args * self.arg_bits,
+                depth=self.queue_depth)
+
+        decoded = Cat(decoder.command,
+                      *[decoder.arg[i][:self.arg_bits]
+                        for i in range(self.n_args)])
+
+        if self.binary_decoder is not None:
+            binary_decoder = self.binary_decoder
+            m.submodules.binary_edge = binary_edge = EdgeDetector()
+            m.d.comb += [
+                binary_edge.i.eq(binary_decoder.ready),
+                start.eq(Mux(self.protocol, binary_edge.rose,
+                             decode_edge.rose))
+            ]
+            decoded = Mux(self.protocol,
+                          Cat(binary_decoder.command,
+                              *[binary_decoder.arg[i][:self.arg_bits]
+                                for i in range(self.n_args)]),
+                          decoded)
+        else:
+            m.d.comb += start.eq(decode_edge.rose)
 
         m.d.comb += [
             decode_ready.eq(decoder.ready),
-            command.eq(decoder.command),
-            *[arg[i].eq(decoder.arg[i]) for i in range(self.n_args)]
+            cmd_fifo.w_data.eq(decoded),
+            Cat(command, *arg).eq(cmd_fifo.r_data),
+            pending.eq(cmd_fifo.r_rdy)
+        ]
+
+        # the protocol is switched right away and not queued, so the next
+        # received byte already goes to the selected decoder
+        if self.binary_decoder is not None:
+            m.d.comb += select_protocol.eq(
+                    start & (cmd_fifo.w_data[:len(command)] == 6))
+            with m.If(select_protocol == 1):
+                m.d.sync += self.protocol.eq(
+                        cmd_fifo.w_data[len(command)])
+
+        m.d.comb += cmd_fifo.w_en.eq(start & ~select_protocol)
+
+        with m.If(self.clear == 1):
+            m.d.sync += self.queue_overflow.eq(0)
+        with m.If((start == 1) & ~select_protocol & (cmd_fifo.w_rdy == 0)):
+            m.d.sync += self.queue_overflow.eq(1)
+
+        # read pipeline
+        m.submodules.read_fifo = read_fifo = SyncFIFO(
+                width=self.data_bits, depth=self.read_depth)
+
+        next_addr = Signal(self.addr_bits)
+        n_issue = Signal(16)
+        n_send = Signal(16)
+        count = Signal(16)
+        block = Signal()
+        re_delay = Signal(self.read_latency)
+
+        m.d.sync += re_delay.eq(Cat(re, re_delay[:-1]))
+
+        m.d.comb += [
+            count.eq(Mux(arg[1][0:16] == 0, 1, arg[1][0:16])),
+            read_fifo.w_data.eq(read_data),
+            read_fifo.w_en.eq(re_delay[-1]),
+            encoder.data.eq(read_fifo.r_data),
+            encoder.last.eq((block == 0) | (n_send == 1))
         ]
 
         with m.FSM(reset="WAIT_START") as fsm:
             _ = fsm
             with m.State("WAIT_START"):
-                with m.If((start == 1) & (command == 1)):
-                    m.d.sync += read_val.eq(0)
+                m.d.comb += cmd_fifo.r_en.eq(pending)
+                with m.If((pending == 1) & ((command == 1) | (command == 5))):
+                    m.d.sync += [
+                        next_addr.eq(arg[0][0:16]), # Limit address space
+                        n_issue.eq(count),          # Limit multi-read to 65k
+                        n_send.eq(count),
+                        block.eq(command == 5)
+                    ]
                     m.next = "READ"
-                with m.Elif((start == 1) & (command == 2)):
+                with m.Elif((pending == 1) & (command == 2)):
+                    m.d.sync += [
+                        write_addr.eq(arg[0]),
+                        write_data.eq(arg[1])
+                    ]
                     m.next = "WRITE"
+                with m.Elif((pending == 1) & (command == 4)):
+                    # output format of the encoder, see serial_encoder.py
+                    m.d.sync += encoder.mode.eq(arg[0])
+                    m.next = "WAIT_START"
                 with m.Else():
                     m.next = "WAIT_START"
 
             with m.State("READ"):
-                m.d.sync += [
-                    read_addr.eq(arg[0][0:16]), # Limit address space to 0xffff
-                    read_val.eq(arg[1][0:16]),  # Limit multi-read to 65k
-                ]
-                m.next = "READ_ON"
-            with m.State("READ_ON"):
-                m.d.sync += re.eq(1)
-                m.next = "READ_OFF"
-            with m.State("READ_OFF"):
-                m.d.sync += re.eq(0)
-                m.next = "GET_DATA"
-            with m.State("GET_DATA"):
-                m.d.sync += uart_tx_data.eq(read_data)
-                m.next = "SEND_DATA"
-            with m.State("SEND_DATA"):
-                m.next = "SEND_DELAY"
-            with m.State("SEND_DELAY"):
-                m.d.sync += [
-                    encoder.data.eq(uart_tx_data),
-                    encoder.write.eq(1),
-                ]
-                m.next = "SEND_DATA2"
-            with m.State("SEND_DATA2"):
-                m.d.sync += encoder.write.eq(0),
-                m.next = "START_ENCODE"
-            with m.State("START_ENCODE"):
-                m.d.sync += encoder.trg.eq(1)
-                m.next = "SENDER_PAUSE"
-            with m.State("SENDER_PAUSE"):
-                m.d.sync += encoder.trg.eq(0),
-                m.next = "WAIT_SENDER_READY"
-            with m.State("WAIT_SENDER_READY"):
-                with m.If(encoder.rdy == 1):
-                    with m.If(read_val > 1):
-                        m.d.sync += [
-                            read_val.eq(read_val - 1),
-                            read_addr.eq(read_addr + 1)
-                        ]
-                        m.next = "READ_ON"
-                    with m.Else():
+                # keep room in the FIFO for the reads still in flight
+                with m.If((n_issue > 0) & (read_fifo.level <
+                        self.read_depth - self.read_latency - 2)):
+                    m.d.sync += [
+                        re.eq(1),
+                        read_addr.eq(next_addr),
+                        next_addr.eq(next_addr + 1),
+                        n_issue.eq(n_issue - 1)
+                    ]
+                with m.Else():
+                    m.d.sync += re.eq(0)
+
+                m.d.comb += encoder.valid.eq(read_fifo.r_rdy)
+                with m.If((read_fifo.r_rdy == 1) & (encoder.ready == 1)):
+                    m.d.comb += read_fifo.r_en.eq(1)
+                    m.d.sync += n_send.eq(n_send - 1)
+                    with m.If(n_send == 1):
                         m.next = "WAIT_START"
 
             with m.State("WRITE"):
-                m.d.sync += [
-                    we.eq(1),
-                    write_addr.eq(arg[0]),
-                    write_data.eq(arg[1])
-                ]
+                m.d.sync += we.eq(1)
                 m.next = "WRITE_END"
             with m.State("WRITE_END"):
                 m.d.sync += [
@@ -211,3 +359,226 @@ class UartFsm(Elaboratable):
                 m.next = "WAIT_START"
 
         return m
+
+
+class RegisterModel(Elaboratable):
+    # registers with a synchronous read, as a stand-in for a design in
+    # simulations
+    def __init__(self, uart_io, n_regs=64):
+        self.uart_io = uart_io
+        self.regs = Array([Signal(uart_io.data_bits, reset=1000 + 7 * i,
+                                  name="reg{}".format(i))
+                           for i in range(n_regs)])
+        self.r_data = Signal(uart_io.data_bits)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.uart_io = dut = self.uart_io
+        m.d.comb += dut.r_data.eq(self.r_data)
+        with m.If(dut.re == 1):
+            m.d.sync += self.r_data.eq(self.regs[dut.r_addr])
+        with m.If(dut.we == 1):
+            m.d.sync += self.regs[dut.w_addr].eq(dut.w_data)
+        return m
+
+
+class BankModel(Elaboratable):
+    # a RegisterBank (see register_list.py) behind a UartIO
+    def __init__(self, uart_io, bank):
+        self.uart_io = uart_io
+        self.bank = bank
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.uart_io = dut = self.uart_io
+        m.submodules.bank = bank = self.bank
+        m.d.comb += [
+            bank.we.eq(dut.we),
+            bank.w_addr.eq(dut.w_addr),
+            bank.w_data.eq(dut.w_data),
+            bank.re.eq(dut.re),
+            bank.r_addr.eq(dut.r_addr),
+            dut.r_data.eq(bank.r_data)
+        ]
+        return m
+
+
+def sim_uart_io(test, divisor=8, data_bits=32, addr_bits=16,
+                model=RegisterModel, **kwargs):
+    # runs 'test' with a host that talks to a UartIO over its pins.
+    # test(host) is a generator, host.send(text) writes a command and
+    # host.receive(n) waits for n bytes from the UartIO. model(uart_io) is
+    # the design behind it.
+    dut = UartIO(data_bits=data_bits, addr_bits=addr_bits, **kwargs)
+    top = model(dut)
+
+    sim = Simulator(top)
+
+    class Host:
+        received = bytearray()
+
+        def send(self, text):
+            if isinstance(text, str):
+                text = text.encode()
+            for c in text:
+                for bit in [0] + [(c >> i) & 1 for i in range(8)] + [1]:
+                    yield dut.rx_pin.eq(bit)
+                    for _ in range(divisor):
+                        yield
+
+        def receive(self, n, timeout=100000):
+            for _ in range(timeout):
+                if len(self.received) >= n:
+                    break
+                yield
+            assert len(self.received) >= n, bytes(self.received)
+            data = bytes(self.received[:n])
+            del self.received[:n]
+            return data
+
+    host = Host()
+    host.dut = dut
+
+    def rx():
+        yield Passive()
+        while True:
+            yield
+            if (yield dut.tx_pin) == 0:
+                for _ in range(divisor // 2):
+                    yield
+                c = 0
+                for i in range(8):
+                    for _ in range(divisor):
+                        yield
+                    c |= (yield dut.tx_pin) << i
+                for _ in range(divisor):
+                    yield
+                host.received.append(c)
+
+    def proc():
+        yield dut.divisor.eq(divisor)
+        yield dut.rx_pin.eq(1)
+        for _ in range(4 * divisor):
+            yield
+        yield from test(host)
+
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(rx)
+    sim.run()
+
+
+if __name__ == '__main__':
+
+    def frame(opcode, *args):
+        # binary command: opcode, then the arguments as (value, n_bytes),
+        # little endian
+        return bytes([opcode]) + b"".join(
+                a.to_bytes(n, "little") for a, n in args)
+
+    def test_read(host):
+        yield from host.send("R 3\r\n")
+        assert (yield from host.receive(7)) == b"1021 \r\n"
+        yield from host.send("R 5 3\r\n")
+        assert (yield from host.receive(21)) == b"1035 \r\n1042 \r\n1049 \r\n"
+        yield from host.send("W 4 77\r\n")
+        yield from host.send("R 4\r\n")
+        assert (yield from host.receive(5)) == b"77 \r\n"
+
+    def test_block(host):
+        yield from host.send("B 10 20\r\n")
+        expected = "".join("{} ".format(1000 + 7 * i) for i in range(10, 30))
+        assert (yield from host.receive(len(expected) + 2)) == \
+            expected.encode() + b"\r\n"
+        yield from host.send("M 2\r\n")
+        yield from host.send("B 0 3\r\n")
+        expected = b"".join((1000 + 7 * i).to_bytes(4, "little")
+                            for i in range(3))
+        assert (yield from host.receive(14)) == expected + b"\r\n"
+
+    def test_queue(host):
+        # send without waiting for the responses
+        yield from host.send("R 3\r\nR 4\r\nW 4 77\r\nR 4\r\nB 0 2\r\n")
+        expected = b"1021 \r\n1028 \r\n77 \r\n1000 1007 \r\n"
+        assert (yield from host.receive(len(expected))) == expected
+
+    def test_binary(host):
+        yield from host.send("P 1\r\n")
+        yield from host.send(frame(1, (3, 2), (2, 2)))
+        assert (yield from host.receive(14)) == b"1021 \r\n1028 \r\n"
+        yield from host.send(frame(2, (4, 2), (0x12345678, 4)))
+        yield from host.send(frame(4, (2, 1)))
+        yield from host.send(frame(5, (3, 2), (2, 2)))
+        expected = (1021).to_bytes(4, "little") \
+            + (0x12345678).to_bytes(4, "little")
+        assert (yield from host.receive(10)) == expected + b"\r\n"
+        yield from host.send(frame(4, (0, 1)))
+        yield from host.send(frame(6, (0, 1)))
+        yield from host.send("R 5\r\n")
+        assert (yield from host.receive(7)) == b"1035 \r\n"
+
+    def test_default(host):
+        # default UartIO: 8 bit data, 4 bit addresses, 16 bit count
+        yield from host.send("B 3 3\r\n")
+        expected = "".join("{} ".format((1000 + 7 * i) & 0xff)
+                           for i in range(3, 6))
+        assert (yield from host.receive(len(expected) + 2)) == \
+            expected.encode() + b"\r\n"
+        yield from host.send("P 1\r\n")
+        yield from host.send(frame(2, (4, 1), (0xa5, 1)))
+        yield from host.send(frame(5, (3, 1), (2, 2)))
+        expected = "{} {} ".format((1000 + 21) & 0xff, 0xa5)
+        assert (yield from host.receive(len(expected) + 2)) == \
+            expected.encode() + b"\r\n"
+
+    def test_clear(host):
+        # a long response keeps the queue busy, the last commands overflow it
+        yield from host.send("B 0 30\r\n" + "R 1\r\n" * 6)
+        yield from host.receive(30 * 5 + 2)
+        yield from host.receive(4 * 7)
+        assert (yield host.dut.queue_overflow) == 1
+        # a forced overrun
+        yield host.dut.uart.rx_overrun.eq(1)
+        yield
+        assert (yield host.dut.rx_overrun) == 1
+        yield host.dut.clear.eq(1)
+        yield
+        yield host.dut.clear.eq(0)
+        yield
+        assert (yield host.dut.queue_overflow) == 0
+        assert (yield host.dut.rx_overrun) == 0
+        yield from host.send("R 1\r\n")
+        assert (yield from host.receive(7)) == b"1007 \r\n"
+        assert (yield host.dut.queue_overflow) == 0
+
+    def sim_bank(n_regs=64, fanin=2):
+        # a deep read tree, read_latency 6 with 64 registers and fanin 2
+        from register_list import RegisterFile, RegisterTable
+        regs = RegisterFile("bank")
+        table = RegisterTable("bank", "b")
+        table.add_list("cnt", 0x100, names=[
+            ("c{}".format(i), 32, 1000 + 7 * i) for i in range(n_regs)])
+        regs.add_table(table)
+        bank = regs.bank(fanin=fanin)
+        assert bank.read_latency == 6
+
+        def test(host):
+            yield from host.send("B 256 {}\r\n".format(n_regs))
+            expected = "".join("{} ".format(1000 + 7 * i)
+                               for i in range(n_regs))
+            assert (yield from host.receive(len(expected) + 2)) == \
+                expected.encode() + b"\r\n"
+            yield from host.send("W 260 5\r\nR 259 2\r\n")
+            assert (yield from host.receive(11)) == b"1021 \r\n5 \r\n"
+
+        sim_uart_io(test, read_latency=bank.read_latency,
+                    model=lambda uart_io: BankModel(uart_io, bank))
+
+    sim_uart_io(test_read)
+    sim_uart_io(test_block)
+    sim_uart_io(test_block, bcd_stages=4)
+    sim_uart_io(test_queue)
+    sim_uart_io(test_binary, binary_protocol=True)
+    sim_uart_io(test_clear)
+    sim_uart_io(test_default, data_bits=8, addr_bits=4, binary_protocol=True)
+    sim_bank()